@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import ipaddress
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# IP version -> prefix length -> the network addresses (as ints, shifted down to the prefix)
+Prefixes = dict[int, dict[int, set[int]]]
+
+
+def compile_blocklist(text: str) -> Prefixes:
+    """Parse a blocklist (one address or CIDR block per line, # for comments).
+
+    Networks are grouped by prefix length so a lookup is one set membership test per
+    distinct prefix length in the list, however many entries it has.
+    """
+    prefixes: Prefixes = {4: {}, 6: {}}
+    for lineno, line in enumerate(text.splitlines(), start=1):
+        line = line.partition("#")[0].strip()
+        if not line:
+            continue
+        try:
+            network = ipaddress.ip_network(line, strict=False)
+        except ValueError:
+            logger.warning(f"Ignoring invalid blocklist entry on line {lineno}: {line!r}")
+            continue
+        shift = network.max_prefixlen - network.prefixlen
+        by_length = prefixes[network.version].setdefault(network.prefixlen, set())
+        by_length.add(int(network.network_address) >> shift)
+    return prefixes
+
+
+class IPBlocklist:
+    """A set of blocked IP networks, reloaded whenever the file it's read from changes.
+
+    The file is checked for changes (with a stat call) at most every `check_interval`
+    seconds. A missing file means nothing is blocked.
+    """
+
+    def __init__(self, path: Optional[Path], check_interval: float = 1.0) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self.size = 0
+        self.matches = 0
+        self.reloads = 0
+        self._prefixes: Prefixes = {4: {}, 6: {}}
+        self._signature: Optional[tuple[int, int, int]] = None
+        self._next_check = 0.0
+        self.maybe_reload()
+
+    def maybe_reload(self) -> None:
+        if self.path is None:
+            return
+
+        self._next_check = time.monotonic() + self.check_interval
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            signature = None
+        else:
+            signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if signature == self._signature:
+            return
+
+        try:
+            text = self.path.read_text(encoding="utf-8") if signature is not None else ""
+        except OSError:
+            logger.exception(f"Failed to reload IP blocklist from {self.path}, keeping the old one")
+            return
+
+        self._prefixes = compile_blocklist(text)
+        self._signature = signature
+        self.size = sum(len(s) for by_length in self._prefixes.values() for s in by_length.values())
+        self.reloads += 1
+        logger.info(f"Loaded IP blocklist ({self.size} networks) from {self.path}")
+
+    def is_blocked(self, ip: str) -> bool:
+        if time.monotonic() >= self._next_check:
+            self.maybe_reload()
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        value = int(address)
+        for length, networks in self._prefixes[address.version].items():
+            if value >> (address.max_prefixlen - length) in networks:
+                self.matches += 1
+                return True
+        return False
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "path": str(self.path) if self.path else None,
+            "networks": self.size,
+            "matches": self.matches,
+            "reloads": self.reloads,
+        }
@@ -0,0 +1,109 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Hashable, Iterable, NamedTuple, Optional, Union
+
+from .models import Deck, DeckVersion
+
+
+def deck_etag(deck: Union[Deck, DeckVersion]) -> str:
+    """Return a strong ETag for a deck.
+
+    Every change to a deck's name, description or cards bumps updated_at, so along with
+    the other top-level fields exposed in responses that's enough to identify a version.
+    """
+    return _etag(_deck_version_key(deck))
+
+
+def deck_library_etag(decks: Iterable[Union[Deck, DeckVersion]]) -> str:
+    return _etag("|".join(_deck_version_key(d) for d in decks))
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Evaluate an If-None-Match header (using the weak comparison, as per RFC 9110)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def _deck_version_key(deck: Union[Deck, DeckVersion]) -> str:
+    return (
+        f"{deck.id}:{deck.owner}:{deck.public}:"
+        f"{deck.updated_at.isoformat()}:{deck.accessed_at.isoformat()}"
+    )
+
+
+def _etag(key: str) -> str:
+    return '"' + hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '"'
+
+
+class CachedResponse(NamedTuple):
+    etag: str
+    body: bytes
+    expires_at: float
+
+
+class ResponseCache:
+    """An in-process LRU cache of serialized response bodies.
+
+    Entries expire after `ttl` and the least recently used ones are evicted once the
+    cached bodies exceed `max_bytes` in total. Lookups pass the resource's current
+    ETag so a stale entry is never served even if an invalidation was missed.
+    """
+
+    def __init__(self, max_bytes: int, ttl: timedelta) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl.total_seconds()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, CachedResponse] = OrderedDict()
+
+    def get(self, key: Hashable, etag: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry.etag != etag or entry.expires_at <= time.monotonic():
+            self.invalidate(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.body
+
+    def put(self, key: Hashable, etag: str, body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+
+        self.invalidate(key)
+        self._entries[key] = CachedResponse(etag, body, time.monotonic() + self.ttl)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.body)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        if (entry := self._entries.pop(key, None)) is not None:
+            self.size -= len(entry.body)
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "entries": len(self._entries),
+            "size_bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -32,21 +32,40 @@ LOG_CONFIG: Final = {
 opt = Options("TMC")
 # --- Database --- #
 
-DATABASE_PATH: Final = opt("database", Path)
+DATABASE_PATH: Final              = opt("database",                   Path)
+DATABASE_POOL_SIZE: Final         = opt("database-pool-size",         int,       default=4)
+DATABASE_READ_POOL_SIZE: Final    = opt("database-read-pool-size",    int,       default=4)
+DATABASE_PROFILE: Final           = opt("database-profile",           str,       default="default")
+WAL_CHECKPOINT_INTERVAL: Final    = opt("wal-checkpoint-interval",    TimeDelta, default="minutes=5")
+
+REQUEST_LOG_FLUSH_SIZE: Final     = opt("request-log-flush-size",     int,       default=100)
+REQUEST_LOG_FLUSH_INTERVAL: Final = opt("request-log-flush-interval", TimeDelta, default="seconds=5")
+REQUEST_LOG_MAX_BUFFERED: Final   = opt("request-log-max-buffered",   int,       default=10_000)
+
+DECK_CACHE_MAX_BYTES: Final       = opt("deck-cache-max-bytes",       int,       default=16 * 1024 * 1024)
+DECK_CACHE_TTL: Final             = opt("deck-cache-ttl",             TimeDelta, default="minutes=10")
 
 # --- Authentication --- #
 
-ALLOW_NEW_USERS: Final       = opt("allow-new-users",       bool,      default=False)
-REFRESH_COOKIE_NAME: Final   = opt("refresh-cookie-name",   str,       default="RefreshCookie")
+ALLOW_NEW_USERS: Final             = opt("allow-new-users",             bool,      default=False)
+REFRESH_COOKIE_NAME: Final         = opt("refresh-cookie-name",         str,       default="RefreshCookie")
+
+ACCESS_TOKEN_LIFETIME: Final       = opt("access-token-lifetime",       TimeDelta, default="minutes=30")
+SESSION_LIFETIME: Final            = opt("session-lifetime",            TimeDelta, default="days=1")
+SESSION_PURGE_DELTA: Final         = opt("session-purge-after",         TimeDelta, default="days=2")
+SESSION_SWEEP_INTERVAL: Final      = opt("session-sweep-interval",      TimeDelta, default="minutes=30")
+MAX_SESSIONS: Final                = opt("max-sessions",                int,       default=50)
+RATE_LIMIT_PERSIST_INTERVAL: Final = opt("rate-limit-persist-interval", TimeDelta, default="minutes=1")
 
-ACCESS_TOKEN_LIFETIME: Final = opt("access-token-lifetime", TimeDelta, default="minutes=30")
-SESSION_LIFETIME: Final      = opt("session-lifetime",      TimeDelta, default="days=1")
-SESSION_PURGE_DELTA: Final   = opt("session-purge-after",   TimeDelta, default="days=2")
-MAX_SESSIONS: Final          = opt("max-sessions",          int,       default=50)
+PASSWORD_WORKERS: Final            = opt("password-workers",            int,       default=2)
+PASSWORD_WORKER_KIND: Final        = opt("password-worker-kind",        str,       default="thread")
+PASSWORD_QUEUE_LIMIT: Final        = opt("password-queue-limit",        int,       default=8)
 
 # --- Deployment --- #
 
 TLS_ENABLED: Final            = opt("tls",                bool, default=False)
 USE_UNIX_DOMAIN_SOCKET: Final = opt("unix-domain-socket", bool, default=False)
+# A file of IPs / CIDR blocks to reject (e.g. from scripts/ipfiltering.py --write-blocklist).
+BLOCKLIST_PATH: Final         = opt("blocklist",          str,  default="")
 
 opt.report_errors()
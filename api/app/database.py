@@ -2,36 +2,162 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import asyncio
+import datetime
+import functools
+import logging
 import sqlite3
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterable, Optional, Sequence, TypeVar
 
 import florapi.sqlite
 from florapi import flatten, utc_now
 from ulid import ULID
 
 from . import constants
-from .models import AuthSession, Deck, DeckID, UserInDB, Username
+from .models import AuthSession, Deck, DeckID, DeckVersion, User, UserInDB, Username
+
+T = TypeVar("T")
+logger = logging.getLogger(__name__)
 
 florapi.sqlite.register_adaptors()
 sqlite3.register_adapter(ULID, str)
 
 
 class SQLiteConnection(florapi.sqlite.SQLiteConnection):
+    """A SQLite connection with an identity map for the model getters.
+
+    Users, decks and sessions are only fetched once until `forget()` is called (the
+    pool does so after each request) or a write goes through insert/update/delete.
+    `queries_saved` counts the queries skipped thanks to the identity map.
+    """
+
+    def __init__(self, *args: object, **kwargs: object) -> None:
+        super().__init__(*args, **kwargs)
+        self._identity_map: dict[tuple[str, object], tuple[object, int]] = {}
+        self.queries_saved = 0
+
+    def forget(self) -> None:
+        self._identity_map.clear()
+
+    def _lookup(self, key: tuple[str, object]) -> tuple[bool, object]:
+        if key in self._identity_map:
+            value, cost = self._identity_map[key]
+            self.queries_saved += cost
+            return True, value
+        return False, None
+
+    def _remember(self, key: tuple[str, object], value: object, cost: int) -> None:
+        self._identity_map[key] = (value, cost)
+
+    def insert(self, *args: object, **kwargs: object) -> None:
+        self.forget()
+        return super().insert(*args, **kwargs)
+
+    def insert_many(self, *args: object, **kwargs: object) -> None:
+        self.forget()
+        return super().insert_many(*args, **kwargs)
+
+    def update(self, *args: object, **kwargs: object) -> None:
+        self.forget()
+        return super().update(*args, **kwargs)
+
+    def delete(self, *args: object, **kwargs: object) -> None:
+        self.forget()
+        return super().delete(*args, **kwargs)
+
     def get_user(self, username: Username) -> Optional[UserInDB]:
+        found, user = self._lookup(("user", username))
+        if found:
+            return user
+
         cur = self.execute("SELECT * FROM users WHERE username = ?;", [username])
         if row := cur.fetchone():
             cur = self.execute("SELECT id FROM decks WHERE owner = ?;", [username])
-            return UserInDB(**row, decks=flatten(cur))
-        else:
-            return None
+            user = UserInDB.from_row(row, flatten(cur))
+        self._remember(("user", username), user, cost=2 if user else 1)
+        return user
 
     def get_deck(self, deck_id: DeckID) -> Optional[Deck]:
+        found, deck = self._lookup(("deck", deck_id))
+        if found:
+            return deck
+
         cur = self.execute("SELECT * FROM decks WHERE id = ?;", [deck_id])
         if row := cur.fetchone():
-            cur = self.execute("SELECT * FROM cards WHERE deck_id = ?;", [deck_id])
-            return Deck(**row, cards=list(cur))
-        else:
-            return None
+            cur = self.execute("SELECT * FROM cards WHERE deck_id = ? ORDER BY id;", [deck_id])
+            deck = Deck.from_row(row, cur)
+        self._remember(("deck", deck_id), deck, cost=2 if deck else 1)
+        return deck
+
+    def get_decks(self, deck_ids: Iterable[DeckID]) -> list[Deck]:
+        """Load multiple decks (and their cards) in two queries.
+
+        Decks are returned in the order of the given IDs. Missing decks are skipped.
+        """
+        deck_ids = list(deck_ids)
+        if not deck_ids:
+            return []
+
+        placeholders = ", ".join("?" * len(deck_ids))
+        cur = self.execute(f"SELECT * FROM decks WHERE id IN ({placeholders});", deck_ids)
+        decks = {deck.id: deck for deck in self._attach_cards(cur.fetchall())}
+        for deck in decks.values():
+            self._remember(("deck", deck.id), deck, cost=2)
+        return [decks[id] for id in deck_ids if id in decks]
+
+    def get_deck_version(self, deck_id: DeckID) -> Optional[DeckVersion]:
+        """Return the fields needed for a deck's ETag without loading its cards."""
+        cur = self.execute(
+            "SELECT id, owner, public, updated_at, accessed_at FROM decks WHERE id = ?;", [deck_id]
+        )
+        return DeckVersion.from_row(row) if (row := cur.fetchone()) else None
+
+    def get_deck_versions(self, deck_ids: Iterable[DeckID]) -> list[DeckVersion]:
+        """Batched get_deck_version(), in the order of the given IDs."""
+        deck_ids = list(deck_ids)
+        placeholders = ", ".join("?" * len(deck_ids))
+        cur = self.execute(
+            "SELECT id, owner, public, updated_at, accessed_at FROM decks"
+            f" WHERE id IN ({placeholders});",
+            deck_ids,
+        )
+        versions = {row["id"]: DeckVersion.from_row(row) for row in cur}
+        return [versions[id] for id in deck_ids if id in versions]
+
+    def list_users(self, after: Username = "", limit: int = -1) -> list[User]:
+        """Return a page of users (ordered by username) with their deck IDs."""
+        cur = self.execute("""
+            SELECT users.username, users.display_name, users.is_admin, users.created_at,
+                   group_concat(decks.id) AS deck_ids
+            FROM users LEFT JOIN decks ON decks.owner = users.username
+            WHERE users.username > ?
+            GROUP BY users.username ORDER BY users.username LIMIT ?;
+        """, [after, limit])
+        return [
+            User.from_row(row, sorted(int(id) for id in (row["deck_ids"] or "").split(",") if id))
+            for row in cur
+        ]
+
+    def list_decks(self, after: DeckID = 0, limit: int = -1) -> list[Deck]:
+        """Return a page of decks (ordered by ID) with their cards."""
+        cur = self.execute("SELECT * FROM decks WHERE id > ? ORDER BY id LIMIT ?;", [after, limit])
+        return self._attach_cards(cur.fetchall())
+
+    def _attach_cards(self, deck_rows: list[sqlite3.Row]) -> list[Deck]:
+        if not deck_rows:
+            return []
+
+        cards: dict[DeckID, list[sqlite3.Row]] = {row["id"]: [] for row in deck_rows}
+        placeholders = ", ".join("?" * len(cards))
+        cur = self.execute(
+            f"SELECT * FROM cards WHERE deck_id IN ({placeholders}) ORDER BY id;", list(cards)
+        )
+        for card in cur:
+            cards[card["deck_id"]].append(card)
+        return [Deck.from_row(row, cards[row["id"]]) for row in deck_rows]
 
     def get_auth_session(self, *, access: str = "", refresh: str = "", id: str = "") -> Optional[AuthSession]:
         if sum([bool(access), bool(refresh), bool(id)]) != 1:
@@ -39,13 +165,30 @@ class SQLiteConnection(florapi.sqlite.SQLiteConnection):
                 "must specify only one of an access token, refresh token or ULID to search by"
             )
 
+        if access:
+            key = ("session:access", access)
+        elif refresh:
+            key = ("session:refresh", refresh)
+        else:
+            key = ("session:id", id)
+        found, session = self._lookup(key)
+        if found:
+            return session
+
         if access:
             row = self.execute("SELECT * FROM sessions WHERE access_token = ?;", [access]).fetchone()
         if refresh:
             row = self.execute("SELECT * FROM sessions WHERE refresh_token = ?;", [refresh]).fetchone()
         if id:
             row = self.execute("SELECT * FROM sessions WHERE id = ?;", [id]).fetchone()
-        return AuthSession(**row) if row else None
+        if row:
+            session = AuthSession.from_row(row)
+            self._remember(("session:access", session.access_token), session, cost=1)
+            self._remember(("session:refresh", session.refresh_token), session, cost=1)
+            self._remember(("session:id", session.id), session, cost=1)
+        else:
+            self._remember(key, None, cost=1)
+        return session
 
     def get_auth_sessions(
         self, username: Optional[Username], include_expired: bool = True
@@ -54,12 +197,231 @@ class SQLiteConnection(florapi.sqlite.SQLiteConnection):
             cur = self.execute("SELECT * FROM sessions WHERE username = ?;", [username])
         else:
             cur = self.execute("SELECT * FROM sessions;")
-        sessions = [AuthSession(**row) for row in cur]
+        sessions = [AuthSession.from_row(row) for row in cur]
         if include_expired:
             return sessions
         else:
             return [s for s in sessions if utc_now() < s.refresh_expiry]
 
+    def list_auth_sessions(self, after: str = "", limit: int = -1) -> list[AuthSession]:
+        """Return a page of sessions (ordered by ULID)."""
+        cur = self.execute("SELECT * FROM sessions WHERE id > ? ORDER BY id LIMIT ?;", [after, limit])
+        return [AuthSession.from_row(row) for row in cur]
+
+    def count_active_sessions(self, username: Username) -> int:
+        cur = self.execute(
+            "SELECT COUNT(*) FROM sessions WHERE username = ? AND refresh_expiry > ?;",
+            [username, utc_now()],
+        )
+        return cur.fetchone()[0]
+
+    def purge_expired_sessions(self, expired_before: datetime.datetime) -> int:
+        """Delete sessions whose refresh token expired before the given time."""
+        self.forget()
+        cur = self.execute("DELETE FROM sessions WHERE refresh_expiry < ?;", [expired_before])
+        return cur.rowcount
+
+
+# Pragmas applied to every connection, by storage profile (TMC_DATABASE_PROFILE).
+STORAGE_PROFILES: dict[str, dict[str, object]] = {
+    "default": {},
+    "wal": {
+        "journal_mode": "WAL",
+        # In WAL mode, NORMAL only risks losing the last commits on power loss.
+        "synchronous": "NORMAL",
+        "cache_size": -16_000,  # KiB
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+def uses_read_connections(profile: str) -> bool:
+    """Whether reads should get their own (read-only) connections under this profile."""
+    return STORAGE_PROFILES[profile].get("journal_mode") == "WAL"
+
+
+def open_sqlite_connection(*, readonly: bool = False) -> SQLiteConnection:
+    con = florapi.sqlite.open_sqlite_connection(constants.DATABASE_PATH, factory=SQLiteConnection)
+    for pragma, value in STORAGE_PROFILES[constants.DATABASE_PROFILE].items():
+        con.execute(f"PRAGMA {pragma} = {value};")
+    if readonly:
+        con.execute("PRAGMA query_only = ON;")
+    return con
+
+
+def warm_up_connection(con: SQLiteConnection) -> None:
+    """Load the schema and prime the statement cache with the hot-path queries."""
+    con.execute("SELECT name FROM sqlite_master;").fetchall()
+    con.get_user("")
+    con.get_deck(0)
+    # Any non-empty token will do, get_auth_session() rejects empty ones.
+    con.get_auth_session(access="warm-up")
+    con.get_auth_session(refresh="warm-up")
+    con.forget()
+
+
+class AsyncSQLiteConnection:
+    """An awaitable facade over a SQLiteConnection.
+
+    Every call runs on the owning pool's dedicated database thread so slow queries (or
+    fsyncs) don't stall the event loop. Writes commit immediately; use `transaction()`
+    to run several statements atomically.
+    """
+
+    def __init__(self, con: SQLiteConnection, executor: ThreadPoolExecutor) -> None:
+        self.sync = con
+        self._executor = executor
+
+    async def run(self, fn: Callable[..., T], /, *args: object, **kwargs: object) -> T:
+        """Call fn(*args, **kwargs) on the database thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def transaction(self, fn: Callable[..., T], /, *args: object) -> T:
+        """Call fn(connection, *args) on the database thread inside a transaction."""
+        def transact() -> T:
+            with self.sync:
+                return fn(self.sync, *args)
+
+        return await self.run(transact)
+
+    async def execute(self, sql: str, parameters: Sequence[object] = ()) -> list[sqlite3.Row]:
+        return await self.run(lambda: self.sync.execute(sql, parameters).fetchall())
+
+    async def fetchone(self, sql: str, parameters: Sequence[object] = ()) -> Optional[sqlite3.Row]:
+        return await self.run(lambda: self.sync.execute(sql, parameters).fetchone())
+
+    async def insert(self, *args: object, **kwargs: object) -> None:
+        await self.transaction(lambda con: con.insert(*args, **kwargs))
+
+    async def insert_many(self, *args: object, **kwargs: object) -> None:
+        await self.transaction(lambda con: con.insert_many(*args, **kwargs))
+
+    async def update(self, *args: object, **kwargs: object) -> None:
+        await self.transaction(lambda con: con.update(*args, **kwargs))
+
+    async def delete(self, *args: object, **kwargs: object) -> None:
+        await self.transaction(lambda con: con.delete(*args, **kwargs))
+
+    async def get_user(self, username: Username) -> Optional[UserInDB]:
+        return await self.run(self.sync.get_user, username)
+
+    async def get_deck(self, deck_id: DeckID) -> Optional[Deck]:
+        return await self.run(self.sync.get_deck, deck_id)
+
+    async def get_decks(self, deck_ids: Iterable[DeckID]) -> list[Deck]:
+        return await self.run(self.sync.get_decks, list(deck_ids))
+
+    async def get_auth_session(self, **kwargs: str) -> Optional[AuthSession]:
+        return await self.run(self.sync.get_auth_session, **kwargs)
+
+    async def get_auth_sessions(
+        self, username: Optional[Username], include_expired: bool = True
+    ) -> list[AuthSession]:
+        return await self.run(self.sync.get_auth_sessions, username, include_expired)
+
+    async def get_deck_version(self, deck_id: DeckID) -> Optional[DeckVersion]:
+        return await self.run(self.sync.get_deck_version, deck_id)
+
+    async def get_deck_versions(self, deck_ids: Iterable[DeckID]) -> list[DeckVersion]:
+        return await self.run(self.sync.get_deck_versions, list(deck_ids))
+
+    async def list_users(self, after: Username = "", limit: int = -1) -> list[User]:
+        return await self.run(self.sync.list_users, after, limit)
+
+    async def list_decks(self, after: DeckID = 0, limit: int = -1) -> list[Deck]:
+        return await self.run(self.sync.list_decks, after, limit)
+
+    async def list_auth_sessions(self, after: str = "", limit: int = -1) -> list[AuthSession]:
+        return await self.run(self.sync.list_auth_sessions, after, limit)
+
+    async def count_active_sessions(self, username: Username) -> int:
+        return await self.run(self.sync.count_active_sessions, username)
+
+    async def purge_expired_sessions(self, expired_before: datetime.datetime) -> int:
+        return await self.transaction(SQLiteConnection.purge_expired_sessions, expired_before)
+
+
+class ConnectionPool:
+    """A fixed-size pool of long-lived, pre-warmed SQLite connections.
+
+    Connections are handed out one request at a time via `connection()`. Time spent
+    waiting for a free connection is tracked so an undersized pool is easy to spot.
+
+    All of the pool's connections are created and used on a single dedicated thread.
+    """
+
+    def __init__(self, size: int, *, readonly: bool = False) -> None:
+        if size < 1:
+            raise ValueError(f"pool size must be at least one, not {size}")
+
+        self.size = size
+        self.readonly = readonly
+        self._connections: list[SQLiteConnection] = []
+        self._idle: asyncio.Queue[SQLiteConnection] = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(
+            1, thread_name_prefix="tmc-db-read" if readonly else "tmc-db"
+        )
+        self.acquisitions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def open(self) -> None:
+        for _ in range(self.size):
+            con = await self._run(functools.partial(open_sqlite_connection, readonly=self.readonly))
+            await self._run(warm_up_connection, con)
+            self._connections.append(con)
+            self._idle.put_nowait(con)
+
+    async def close(self) -> None:
+        for con in self._connections:
+            await self._run(con.close)
+        self._connections.clear()
+        self._executor.shutdown()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[AsyncSQLiteConnection]:
+        t0 = time.perf_counter()
+        con = await self._idle.get()
+        wait = time.perf_counter() - t0
+        self.acquisitions += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        try:
+            yield AsyncSQLiteConnection(con, self._executor)
+        finally:
+            await self._run(self._reset, con)
+            self._idle.put_nowait(con)
+
+    async def _run(self, fn: Callable[..., T], *args: object) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    @staticmethod
+    def _reset(con: SQLiteConnection) -> None:
+        if con.in_transaction:
+            # Don't leak an uncommitted transaction into the next request.
+            con.rollback()
+        con.forget()
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize(),
+            "acquisitions": self.acquisitions,
+            "wait_total_ms": round(self.total_wait * 1000, 3),
+            "wait_avg_ms": round(self.total_wait * 1000 / max(self.acquisitions, 1), 3),
+            "wait_max_ms": round(self.max_wait * 1000, 3),
+            "queries_saved": sum(con.queries_saved for con in self._connections),
+        }
+
+
+async def checkpoint_wal(pool: ConnectionPool) -> None:
+    """Checkpoint the WAL and truncate it, so it can't grow without bound.
 
-def open_sqlite_connection() -> SQLiteConnection:
-    return florapi.sqlite.open_sqlite_connection(constants.DATABASE_PATH, factory=SQLiteConnection)
+    This is run periodically from the app's lifespan when the WAL storage profile is on.
+    """
+    async with pool.connection() as db:
+        busy, wal_pages, checkpointed = await db.fetchone("PRAGMA wal_checkpoint(TRUNCATE);")
+    if busy:
+        logger.warning(f"WAL checkpoint blocked ({checkpointed}/{wal_pages} pages checkpointed)")
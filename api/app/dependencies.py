@@ -2,16 +2,18 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import sqlite3
 from typing import Annotated, AsyncIterator, NoReturn, Optional
 
 from fastapi import Depends, HTTPException, Path, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from florapi import utc_now
 
+from .caching import ResponseCache
 from .constants import REFRESH_COOKIE_NAME
-from .database import SQLiteConnection, open_sqlite_connection
-from .models import AuthSession, Card, Deck, User, UserInDB
+from .database import AsyncSQLiteConnection, ConnectionPool
+from .models import AuthSession, Card, Deck, DeckVersion, User, UserInDB
+from .passwords import PasswordHasher
+from .ratelimit import RateLimitStore
 
 
 def check_for_resource_owner_or_admin(resource_owner, actor: User) -> None:
@@ -27,21 +29,46 @@ def raise_credentials_error() -> NoReturn:
     )
 
 
-async def setup_database_connection() -> AsyncIterator[sqlite3.Connection]:
-    con = open_sqlite_connection()
-    try:
+def get_database_pool(request: Request) -> ConnectionPool:
+    """Return the read-only pool for GET (and HEAD) requests, or the read-write one.
+
+    Depending on the storage profile, both may be the same pool.
+    """
+    if request.method in ("GET", "HEAD"):
+        return request.app.state.db_read_pool
+    return request.app.state.db_pool
+
+
+async def setup_database_connection(
+    pool: Annotated[ConnectionPool, Depends(get_database_pool)]
+) -> AsyncIterator[AsyncSQLiteConnection]:
+    async with pool.connection() as con:
         yield con
-    finally:
-        con.close()
 
 
-DBConnection = Annotated[SQLiteConnection, Depends(setup_database_connection)]
+def get_password_hasher(request: Request) -> PasswordHasher:
+    return request.app.state.password_hasher
+
+
+def get_rate_limit_store(request: Request) -> RateLimitStore:
+    return request.app.state.rate_limits
+
+
+def get_deck_cache(request: Request) -> ResponseCache:
+    return request.app.state.deck_cache
+
+
+DatabasePool = Annotated[ConnectionPool, Depends(get_database_pool)]
+DBConnection = Annotated[AsyncSQLiteConnection, Depends(setup_database_connection)]
+DeckCache = Annotated[ResponseCache, Depends(get_deck_cache)]
+Passwords = Annotated[PasswordHasher, Depends(get_password_hasher)]
+RateLimits = Annotated[RateLimitStore, Depends(get_rate_limit_store)]
 
 
 async def require_existing_username(
     username: Annotated[str, Path(max_length=20)], db: DBConnection
 ) -> UserInDB:
-    if user := db.get_user(username):
+    if user := await db.get_user(username):
         return user
 
     raise HTTPException(status_code=404, detail="User not found")
@@ -50,15 +77,24 @@ async def require_existing_username(
 async def require_existing_deck(
     deck_id: Annotated[int, Path(ge=1, le=1000)], db: DBConnection
 ) -> Deck:
-    if deck := db.get_deck(deck_id):
+    if deck := await db.get_deck(deck_id):
         return deck
 
     raise HTTPException(status_code=404, detail="Deck not found")
 
 
+async def require_existing_deck_version(
+    deck_id: Annotated[int, Path(ge=1, le=1000)], db: DBConnection
+) -> DeckVersion:
+    if version := await db.get_deck_version(deck_id):
+        return version
+
+    raise HTTPException(status_code=404, detail="Deck not found")
+
+
 async def require_existing_card(card_id: Annotated[str, Path], db: DBConnection) -> Card:
-    if row := db.execute("SELECT * FROM cards WHERE id = ?", [card_id]).fetchone():
-        return Card(**row), db.get_deck(row["deck_id"])
+    if row := await db.fetchone("SELECT * FROM cards WHERE id = ?", [card_id]):
+        return Card.from_row(row), await db.get_deck(row["deck_id"])
 
     raise HTTPException(404, "Card not found")
 
@@ -72,7 +108,7 @@ async def require_access_token(
     if token is None:
         raise_credentials_error()
 
-    session = db.get_auth_session(access=token.credentials)
+    session = await db.get_auth_session(access=token.credentials)
     if session is None:
         raise_credentials_error()
 
@@ -85,7 +121,7 @@ async def require_access_token(
 async def require_signed_in_user(
     session: Annotated[AuthSession, Depends(require_access_token)], db: DBConnection,
 ) -> UserInDB:
-    return db.get_user(session.username)
+    return await db.get_user(session.username)
 
 
 async def may_have_signed_in_user(
@@ -96,7 +132,7 @@ async def may_have_signed_in_user(
 ) -> Optional[UserInDB]:
     try:
         session = await require_access_token(token, db)
-        return db.get_user(session.username)
+        return await db.get_user(session.username)
     except HTTPException:
         # Fallback to no user if credentials are missing, invalid, or expired.
         return None
@@ -109,9 +145,31 @@ async def require_admin_user(user: Annotated[UserInDB, Depends(require_signed_in
     return user
 
 
+async def require_signed_in_user_detached(
+    token: Annotated[
+        Optional[HTTPAuthorizationCredentials], Depends(HTTPBearer(auto_error=False))
+    ],
+    pool: DatabasePool,
+) -> UserInDB:
+    """Like require_signed_in_user, but only holds a pooled connection for the lookups.
+
+    FastAPI keeps dependency connections until the response has been sent, which is
+    too long for endpoints doing slow work that doesn't need the database.
+    """
+    async with pool.connection() as db:
+        session = await require_access_token(token, db)
+        return await require_signed_in_user(session, db)
+
+
+async def require_admin_user_detached(
+    user: Annotated[UserInDB, Depends(require_signed_in_user_detached)]
+) -> UserInDB:
+    return await require_admin_user(user)
+
+
 async def require_refresh_cookie(request: Request, db: DBConnection) -> AuthSession:
     if token := request.cookies.get(REFRESH_COOKIE_NAME):
-        if session := db.get_auth_session(refresh=token):
+        if session := await db.get_auth_session(refresh=token):
             if utc_now() < session.refresh_expiry:
                 return session
 
@@ -120,9 +178,12 @@ async def require_refresh_cookie(request: Request, db: DBConnection) -> AuthSess
 
 ExistingCard = Annotated[tuple[Card, Deck], Depends(require_existing_card)]
 ExistingDeck = Annotated[Deck, Depends(require_existing_deck)]
+ExistingDeckVersion = Annotated[DeckVersion, Depends(require_existing_deck_version)]
 ExistingUser = Annotated[UserInDB, Depends(require_existing_username)]
 SignedInUser = Annotated[UserInDB, Depends(require_signed_in_user)]
 MaybeSignedInUser = Annotated[UserInDB, Depends(may_have_signed_in_user)]
 SignedInAdmin = Annotated[UserInDB, Depends(require_admin_user)]
+DetachedSignedInUser = Annotated[UserInDB, Depends(require_signed_in_user_detached)]
+DetachedSignedInAdmin = Annotated[UserInDB, Depends(require_admin_user_detached)]
 ValidAccessToken = Annotated[AuthSession, Depends(require_access_token)]
 ValidRefreshCookie = Annotated[AuthSession, Depends(require_refresh_cookie)]
@@ -6,13 +6,40 @@ __version__ = "0.1.0"
 
 import logging
 from contextlib import asynccontextmanager
+from pathlib import Path
 
 from fastapi import FastAPI
-from florapi.middleware import ProxyHeadersMiddleware, TimedLogMiddleware
+from florapi.middleware import ProxyHeadersMiddleware
 
-from .constants import LOG_CONFIG, USE_UNIX_DOMAIN_SOCKET
-from .database import open_sqlite_connection
-from .routes import admin, auth, card, deck
+from .blocklist import IPBlocklist
+from .caching import ResponseCache
+from .constants import (
+    BLOCKLIST_PATH,
+    DATABASE_POOL_SIZE,
+    DATABASE_PROFILE,
+    DATABASE_READ_POOL_SIZE,
+    DECK_CACHE_MAX_BYTES,
+    DECK_CACHE_TTL,
+    LOG_CONFIG,
+    PASSWORD_QUEUE_LIMIT,
+    PASSWORD_WORKER_KIND,
+    PASSWORD_WORKERS,
+    RATE_LIMIT_PERSIST_INTERVAL,
+    REQUEST_LOG_FLUSH_INTERVAL,
+    REQUEST_LOG_FLUSH_SIZE,
+    REQUEST_LOG_MAX_BUFFERED,
+    SESSION_PURGE_DELTA,
+    SESSION_SWEEP_INTERVAL,
+    USE_UNIX_DOMAIN_SOCKET,
+    WAL_CHECKPOINT_INTERVAL,
+)
+from .database import ConnectionPool, checkpoint_wal, open_sqlite_connection, uses_read_connections
+from .middleware import BlocklistMiddleware, RequestLogMiddleware, RequestLogSink
+from .passwords import PasswordHasher
+from .ratelimit import RateLimitStore
+from .routes import admin, auth, batch, card, deck
+from .schema import find_unindexed_queries, migrate
+from .utils import cancel_task, run_periodically
 
 logging.config.dictConfig(LOG_CONFIG)
 logger = logging.getLogger(__name__)
@@ -20,11 +47,65 @@ logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> None:
-    app.state.log_db = open_sqlite_connection()
-    logger.info("Opened SQLite connection for request logging middleware")
+    db = open_sqlite_connection()
+    try:
+        migrate(db)
+        for name, plan in find_unindexed_queries(db).items():
+            logger.warning(f"Hot query '{name}' doesn't use an index: {'; '.join(plan)}")
+    finally:
+        db.close()
+    app.state.db_pool = ConnectionPool(DATABASE_POOL_SIZE)
+    await app.state.db_pool.open()
+    logger.info(f"Opened SQLite connection pool ({DATABASE_POOL_SIZE} connections)")
+    wal_checkpointer = None
+    if uses_read_connections(DATABASE_PROFILE):
+        app.state.db_read_pool = ConnectionPool(DATABASE_READ_POOL_SIZE, readonly=True)
+        await app.state.db_read_pool.open()
+        logger.info(f"Opened read-only SQLite connection pool ({DATABASE_READ_POOL_SIZE} connections)")
+        wal_checkpointer = run_periodically(
+            WAL_CHECKPOINT_INTERVAL, checkpoint_wal, app.state.db_pool
+        )
+    else:
+        app.state.db_read_pool = app.state.db_pool
+    app.state.blocklist = IPBlocklist(Path(BLOCKLIST_PATH) if BLOCKLIST_PATH else None)
+    app.state.deck_cache = ResponseCache(DECK_CACHE_MAX_BYTES, DECK_CACHE_TTL)
+    app.state.request_log = RequestLogSink(
+        app.state.db_pool,
+        REQUEST_LOG_FLUSH_SIZE,
+        REQUEST_LOG_FLUSH_INTERVAL,
+        REQUEST_LOG_MAX_BUFFERED,
+    )
+    app.state.request_log.start()
+    app.state.password_hasher = PasswordHasher(
+        PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT, kind=PASSWORD_WORKER_KIND
+    )
+    app.state.password_hasher.start()
+    logger.info(f"Started password hashing pool ({PASSWORD_WORKERS} {PASSWORD_WORKER_KIND} workers)")
+    app.state.rate_limits = RateLimitStore()
+    await app.state.rate_limits.load(app.state.db_pool)
+    rate_limit_persister = run_periodically(
+        RATE_LIMIT_PERSIST_INTERVAL, app.state.rate_limits.persist, app.state.db_pool
+    )
+    session_sweeper = run_periodically(
+        SESSION_SWEEP_INTERVAL, auth.sweep_expired_sessions, app.state.db_pool, SESSION_PURGE_DELTA
+    )
     yield
-    app.state.log_db.close()
-    logger.info("Closed SQLite connection for request logging middleware")
+    if wal_checkpointer is not None:
+        await cancel_task(wal_checkpointer)
+    await cancel_task(session_sweeper)
+    await cancel_task(rate_limit_persister)
+    await app.state.rate_limits.persist(app.state.db_pool)
+    app.state.password_hasher.shutdown()
+    await app.state.request_log.stop()
+    logger.info(f"Flushed request log (written: {app.state.request_log.written})")
+    if app.state.db_read_pool is not app.state.db_pool:
+        await app.state.db_read_pool.close()
+    stats = app.state.db_pool.stats()
+    await app.state.db_pool.close()
+    logger.info(
+        f"Closed SQLite connection pool (acquisitions: {stats['acquisitions']}, "
+        f"avg wait: {stats['wait_avg_ms']}ms, max wait: {stats['wait_max_ms']}ms)"
+    )
 
 
 description = """\
@@ -48,12 +129,13 @@ app = FastAPI(
 
 app.include_router(admin.router)
 app.include_router(auth.router)
+app.include_router(batch.router)
 app.include_router(card.router)
 app.include_router(deck.router)
+# Middleware added later wraps (and runs before) middleware added earlier.
+app.add_middleware(BlocklistMiddleware, blocklist_factory=lambda: app.state.blocklist)
 app.add_middleware(ProxyHeadersMiddleware, require_none_client=USE_UNIX_DOMAIN_SOCKET)
-app.add_middleware(
-    TimedLogMiddleware, sqlite_factory=lambda: app.state.log_db, sqlite_autoclose=False
-)
+app.add_middleware(RequestLogMiddleware, sink_factory=lambda: app.state.request_log)
 
 
 @app.get("/")
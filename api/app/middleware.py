@@ -0,0 +1,187 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+import logging
+import sqlite3
+import time
+from datetime import timedelta
+from typing import Callable, Optional
+
+from florapi import utc_now
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .blocklist import IPBlocklist
+from .database import ConnectionPool, SQLiteConnection
+
+logger = logging.getLogger(__name__)
+
+
+class RequestLogSink:
+    """Buffer request log records in memory and write them to the DB in batches.
+
+    A batch is flushed (in one transaction) once `flush_size` records are waiting or
+    `flush_interval` has passed, whichever comes first. If the buffer is full because
+    the DB can't keep up, new records are dropped and counted.
+    """
+
+    COLUMNS = ("datetime", "ip", "useragent", "referer", "verb", "path", "status", "duration")
+
+    def __init__(
+        self,
+        pool: ConnectionPool,
+        flush_size: int,
+        flush_interval: timedelta,
+        max_buffered: int,
+    ) -> None:
+        self.pool = pool
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.written = 0
+        self.dropped = 0
+        self._buffer: list[tuple] = []
+        self._flush_needed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, record: tuple) -> None:
+        if len(self._buffer) >= self.max_buffered:
+            self.dropped += 1
+            return
+
+        self._buffer.append(record)
+        if len(self._buffer) >= self.flush_size:
+            self._flush_needed.set()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="request-log-sink")
+
+    async def stop(self) -> None:
+        """Stop the background flusher and write out anything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.dropped:
+            logger.warning(f"Dropped {self.dropped} request log record(s)")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), self.flush_interval.total_seconds())
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+
+        batch, self._buffer = self._buffer, []
+        try:
+            async with self.pool.connection() as db:
+                written = await db.run(self._write, db.sync, batch)
+        except sqlite3.Error:
+            logger.exception(f"Failed to write {len(batch)} request log record(s)")
+            self.dropped += len(batch)
+        else:
+            self.written += written
+            self.dropped += len(batch) - written
+
+    def _write(self, db: SQLiteConnection, batch: list[tuple]) -> int:
+        try:
+            with db:
+                db.insert_many("requests", self.COLUMNS, batch)
+            return len(batch)
+        except sqlite3.IntegrityError:
+            # A duplicate timestamp (the primary key) shouldn't cost us the whole batch.
+            written = 0
+            with db:
+                for record in batch:
+                    try:
+                        db.insert("requests", self.COLUMNS, record)
+                        written += 1
+                    except sqlite3.IntegrityError:
+                        pass
+            return written
+
+    def stats(self) -> dict[str, object]:
+        return {"buffered": len(self._buffer), "written": self.written, "dropped": self.dropped}
+
+
+class RequestLogMiddleware:
+    """Time each HTTP request and hand a log record to a RequestLogSink.
+
+    The sink is looked up lazily as it's only created once the app starts up.
+    """
+
+    def __init__(self, app: ASGIApp, sink_factory: Callable[[], RequestLogSink]) -> None:
+        self.app = app
+        self.sink_factory = sink_factory
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timestamp = utc_now()
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - t0
+            headers = Headers(scope=scope)
+            client = scope.get("client")
+            self.sink_factory().add((
+                timestamp,
+                client[0] if client else None,
+                headers.get("user-agent"),
+                headers.get("referer"),
+                scope["method"],
+                scope["path"],
+                status,
+                duration,
+            ))
+
+
+class BlocklistMiddleware:
+    """Reject requests from blocked IPs with a 403 before they reach the app.
+
+    This must run after ProxyHeadersMiddleware so the real client IP is checked. The
+    blocklist is looked up lazily as it's only created once the app starts up.
+    """
+
+    def __init__(self, app: ASGIApp, blocklist_factory: Callable[[], IPBlocklist]) -> None:
+        self.app = app
+        self.blocklist_factory = blocklist_factory
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self._is_blocked(scope):
+            await self.app(scope, receive, send)
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": 403,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", b"9")],
+        })
+        await send({"type": "http.response.body", "body": b"Forbidden"})
+
+    def _is_blocked(self, scope: Scope) -> bool:
+        client = scope.get("client")
+        return bool(client) and self.blocklist_factory().is_blocked(client[0])
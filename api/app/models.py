@@ -3,7 +3,7 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import datetime
-from typing import Any, Mapping, Optional, TypeVar
+from typing import Any, Iterable, Mapping, Optional, TypeVar
 from typing_extensions import Self
 
 import pydantic.fields
@@ -15,6 +15,12 @@ CardID = str
 DeckID = int
 
 
+def parse_datetime(value: object) -> datetime.datetime:
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(str(value))
+
+
 def update_model(model: BaseModelT, update: Mapping[str, object], /) -> BaseModelT:
     """Update a model, merging the new contents of another model into it.
 
@@ -72,11 +78,20 @@ class modelfields:
         Definition = ExtensibleField(min_length=1, max_length=50)
 
 
+# The from_row() constructors below are for rows read from our own database. Their
+# contents were validated on the way in so they skip validation (via construct()),
+# only converting the column types SQLite doesn't preserve.
+
+
 class Card(BaseModel):
     id: CardID
     term: str
     definition: str
 
+    @classmethod
+    def from_row(cls, row: Mapping[str, Any]) -> Self:
+        return cls.construct(id=str(row["id"]), term=row["term"], definition=row["definition"])
+
 
 class Deck(BaseModel, validate_assignment=True):
     id: DeckID
@@ -89,6 +104,40 @@ class Deck(BaseModel, validate_assignment=True):
     description: str
     cards: list[Card]
 
+    @classmethod
+    def from_row(cls, row: Mapping[str, Any], cards: Iterable[Mapping[str, Any]]) -> Self:
+        return cls.construct(
+            id=row["id"],
+            owner=row["owner"],
+            public=bool(row["public"]),
+            created_at=parse_datetime(row["created_at"]),
+            updated_at=parse_datetime(row["updated_at"]),
+            accessed_at=parse_datetime(row["accessed_at"]),
+            name=row["name"],
+            description=row["description"],
+            cards=[Card.from_row(card) for card in cards],
+        )
+
+
+class DeckVersion(BaseModel):
+    """The subset of a deck's fields that determine its ETag."""
+
+    id: DeckID
+    owner: Optional[Username]
+    public: bool
+    updated_at: datetime.datetime
+    accessed_at: datetime.datetime
+
+    @classmethod
+    def from_row(cls, row: Mapping[str, Any]) -> Self:
+        return cls.construct(
+            id=row["id"],
+            owner=row["owner"],
+            public=bool(row["public"]),
+            updated_at=parse_datetime(row["updated_at"]),
+            accessed_at=parse_datetime(row["accessed_at"]),
+        )
+
 
 class User(BaseModel):
     username: str
@@ -97,6 +146,19 @@ class User(BaseModel):
     created_at: datetime.datetime
     decks: list[DeckID]
 
+    @classmethod
+    def from_row(cls, row: Mapping[str, Any], decks: list[DeckID]) -> Self:
+        fields = {
+            "username": row["username"],
+            "display_name": row["display_name"],
+            "is_admin": bool(row["is_admin"]),
+            "created_at": parse_datetime(row["created_at"]),
+            "decks": decks,
+        }
+        if "hashed_password" in cls.__fields__:
+            fields["hashed_password"] = row["hashed_password"]
+        return cls.construct(**fields)
+
 
 class UserInDB(User):
     hashed_password: str
@@ -111,6 +173,18 @@ class AuthSession(BaseModel):
     access_expiry: datetime.datetime
     created_at: datetime.datetime
 
+    @classmethod
+    def from_row(cls, row: Mapping[str, Any]) -> Self:
+        return cls.construct(
+            id=row["id"],
+            username=row["username"],
+            refresh_token=row["refresh_token"],
+            refresh_expiry=parse_datetime(row["refresh_expiry"]),
+            access_token=row["access_token"],
+            access_expiry=parse_datetime(row["access_expiry"]),
+            created_at=parse_datetime(row["created_at"]),
+        )
+
 
 class CardTemplate(BaseModel):
     term: str = modelfields.Card.Term
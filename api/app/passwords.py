@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+T = TypeVar("T")
+
+passlib_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def hash_password(password: str) -> str:
+    return passlib_context.hash(password)
+
+
+def verify_password(password: str, hashed_password: str) -> bool:
+    return passlib_context.verify(password, hashed_password)
+
+
+class PasswordHasher:
+    """Run bcrypt hashing and verification on a bounded worker pool.
+
+    bcrypt is deliberately slow, so doing it on the event loop stalls every other
+    request. Once `workers + max_queued` operations are in flight, new ones are
+    rejected with 503 Service Unavailable instead of piling up.
+    """
+
+    def __init__(self, workers: int, max_queued: int, kind: str = "thread") -> None:
+        if kind not in ("thread", "process"):
+            raise ValueError(f"unknown password worker kind: {kind!r} (expected thread or process)")
+
+        self.workers = workers
+        self.max_queued = max_queued
+        self.kind = kind
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+
+    def start(self) -> None:
+        if self.kind == "process":
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="tmc-passwords")
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(hash_password, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._submit(verify_password, password, hashed_password)
+
+    def check_capacity(self) -> None:
+        """Raise 503 if a new operation would be rejected right now.
+
+        Call this before taking other resources (like a DB connection) for the request.
+        """
+        if self.in_flight >= self.workers + self.max_queued:
+            self.rejected += 1
+            raise HTTPException(
+                503, detail="Server is busy, please try again later", headers={"Retry-After": "1"}
+            )
+
+    async def _submit(self, fn: Callable[..., T], *args: object) -> T:
+        self.check_capacity()
+        self.in_flight += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        return result
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_queued": self.max_queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
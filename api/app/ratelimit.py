@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Mapping
+
+from .database import ConnectionPool, SQLiteConnection
+from .models import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+# (key, duration in seconds, window expiry as a UNIX timestamp)
+Bucket = tuple[str, int, int]
+
+
+class RateLimitStore:
+    """In-memory, sliding window rate limit counters.
+
+    Hits are counted in fixed windows, and the count over the last `duration` seconds
+    is estimated from the current window plus the previous one, weighted by how much
+    of it still overlaps. So unlike with plain fixed windows, a burst straddling a
+    window boundary can't get twice the limit through.
+
+    Counters are written to the `_ratelimits` table by `persist()` (called
+    periodically) rather than on every update, and reloaded with `load()` so they
+    survive restarts.
+    """
+
+    def __init__(self) -> None:
+        self._counters: dict[Bucket, int] = {}
+        self._dirty: set[Bucket] = set()
+
+    def get(self, key: str, duration: int) -> float:
+        now = time.time()
+        expiry = self._window_expiry(now, duration)
+        current = self._counters.get((key, duration, expiry), 0)
+        previous = self._counters.get((key, duration, expiry - duration), 0)
+        # The part of the previous window that's still within the last `duration` seconds.
+        overlap = (expiry - now) / duration
+        return previous * overlap + current
+
+    def increment(self, key: str, duration: int) -> None:
+        bucket = (key, duration, self._window_expiry(time.time(), duration))
+        self._counters[bucket] = self._counters.get(bucket, 0) + 1
+        self._dirty.add(bucket)
+
+    @staticmethod
+    def _window_expiry(now: float, duration: int) -> int:
+        return (int(now) // duration + 1) * duration
+
+    async def load(self, pool: ConnectionPool) -> None:
+        async with pool.connection() as db:
+            rows = await db.execute("SELECT * FROM _ratelimits;")
+        for row in rows:
+            expiry = int(parse_datetime(row["expiry"]).timestamp())
+            self._counters[row["key"], row["duration"], expiry] = row["value"]
+        logger.info(f"Loaded {len(self._counters)} rate limit counter(s)")
+
+    async def persist(self, pool: ConnectionPool) -> None:
+        """Write changed counters to the DB and forget the ones no longer needed."""
+        now = time.time()
+        # A window is still needed while it's the current or the previous one.
+        expired = [b for b in self._counters if b[2] + b[1] <= now]
+        for bucket in expired:
+            del self._counters[bucket]
+        dirty, self._dirty = self._dirty, set()
+        rows = [
+            (key, duration, self._counters[key, duration, expiry], self._timestamp(expiry))
+            for key, duration, expiry in dirty
+            if (key, duration, expiry) in self._counters
+        ]
+        expired_rows = [
+            (key, duration, self._timestamp(expiry)) for key, duration, expiry in expired
+        ]
+        try:
+            async with pool.connection() as db:
+                await db.transaction(self._write, rows, expired_rows)
+        except BaseException:
+            # Try again next time, with whatever the counts are by then.
+            self._dirty |= dirty
+            raise
+
+    @staticmethod
+    def _timestamp(expiry: int) -> datetime:
+        return datetime.fromtimestamp(expiry, timezone.utc)
+
+    @staticmethod
+    def _write(db: SQLiteConnection, rows: list[tuple], expired_rows: list[tuple]) -> None:
+        db.executemany(
+            "INSERT INTO _ratelimits (key, duration, value, expiry) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (key, duration, expiry) DO UPDATE SET value = excluded.value;",
+            rows,
+        )
+        db.executemany(
+            "DELETE FROM _ratelimits WHERE key = ? AND duration = ? AND expiry = ?;", expired_rows
+        )
+
+    def stats(self) -> dict[str, object]:
+        return {"counters": len(self._counters), "unpersisted": len(self._dirty)}
+
+
+class RateLimiter:
+    """A rate limiter backed by a RateLimitStore (without any DB access).
+
+    `limits` maps window durations to the maximum number of hits allowed within the
+    window. This mirrors the interface of florapi.security.RateLimiter.
+    """
+
+    MINUTE = timedelta(minutes=1)
+    HOUR = timedelta(hours=1)
+    DAY = timedelta(days=1)
+
+    def __init__(self, name: str, limits: Mapping[timedelta, int], store: RateLimitStore) -> None:
+        self.name = name
+        self.limits = {int(d.total_seconds()): limit for d, limit in limits.items()}
+        self.store = store
+
+    def should_block(self, key: str) -> bool:
+        return any(
+            self.store.get(f"{self.name}:{key}", duration) >= limit
+            for duration, limit in self.limits.items()
+        )
+
+    def update(self, key: str) -> None:
+        for duration in self.limits:
+            self.store.increment(f"{self.name}:{key}", duration)
+
+    def update_and_check(self, key: str) -> bool:
+        blocked = self.should_block(key)
+        self.update(key)
+        return blocked
@@ -2,33 +2,126 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from fastapi import APIRouter
-from florapi import flatten
+from typing import Annotated, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from fastapi import APIRouter, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 
 from .. import dependencies as deps
-from ..models import AuthSession, Deck, User
+from ..database import AsyncSQLiteConnection, ConnectionPool
+from ..models import AuthSession, Deck, DeckID, User
+from ..utils import dump_json
 
 router = APIRouter(prefix="/admin", tags=["admin"])
+CursorT = TypeVar("CursorT")
+PageLimit = Annotated[Optional[int], Query(ge=1)]
+EXPORT_PAGE_SIZE = 200
+
+
+async def stream_ndjson(
+    pool: ConnectionPool,
+    fetch_page: Callable[[AsyncSQLiteConnection, CursorT, int], Awaitable[list[BaseModel]]],
+    cursor_of: Callable[[BaseModel], CursorT],
+    after: CursorT,
+    limit: Optional[int],
+) -> AsyncIterator[str]:
+    """Stream a table as NDJSON, fetching it page by page.
+
+    A pooled connection is only held while fetching each page so a slow client can't
+    hog it, and at most one page is ever held in memory. The caller mustn't hold a
+    connection from the same pool for the lifetime of the response (as DBConnection
+    does), or concurrent exports could deadlock it.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page_size = EXPORT_PAGE_SIZE if remaining is None else min(EXPORT_PAGE_SIZE, remaining)
+        async with pool.connection() as db:
+            page = await fetch_page(db, after, page_size)
+        for item in page:
+            yield item.json() + "\n"
+        if len(page) < page_size:
+            break
+        after = cursor_of(page[-1])
+        if remaining is not None:
+            remaining -= len(page)
+
+
+def ndjson_response(content: AsyncIterator[str]) -> StreamingResponse:
+    return StreamingResponse(content, media_type="application/x-ndjson")
 
 
 @router.get("/list-users")
 async def list_users(_: deps.SignedInAdmin, db: deps.DBConnection) -> list[User]:
-    users = []
-    for row in db.execute("SELECT * FROM users;"):
-        cur = db.execute("SELECT id FROM decks WHERE owner = ?;", [row["username"]])
-        users.append(dict(**row, decks=flatten(cur.fetchall())))
-    return users
+    return await db.list_users()
 
 
 @router.get("/list-decks")
 async def list_decks(_: deps.SignedInAdmin, db: deps.DBConnection) -> list[Deck]:
-    decks = []
-    for row in db.execute("SELECT * FROM decks;"):
-        cur = db.execute("SELECT * FROM cards WHERE deck_id = ?;", [row["id"]])
-        decks.append(Deck(**row, cards=list(cur)))
-    return decks
+    return Response(dump_json(await db.list_decks()), media_type="application/json")
 
 
 @router.get("/list-sessions")
 async def list_sessions(_: deps.SignedInAdmin, db: deps.DBConnection) -> list[AuthSession]:
-    return db.get_auth_sessions(username=None)
+    return await db.get_auth_sessions(username=None)
+
+
+@router.get("/export/users", response_class=StreamingResponse)
+async def export_users(
+    _: deps.DetachedSignedInAdmin,
+    pool: deps.DatabasePool,
+    after: str = "",
+    limit: PageLimit = None,
+):
+    """Stream users ordered by username as NDJSON.
+
+    Pass the username of the last user received as `after` to resume from there.
+    """
+    stream = stream_ndjson(pool, AsyncSQLiteConnection.list_users, lambda u: u.username, after, limit)
+    return ndjson_response(stream)
+
+
+@router.get("/export/decks", response_class=StreamingResponse)
+async def export_decks(
+    _: deps.DetachedSignedInAdmin,
+    pool: deps.DatabasePool,
+    after: DeckID = 0,
+    limit: PageLimit = None,
+):
+    """Stream decks (with cards) ordered by ID as NDJSON.
+
+    Pass the ID of the last deck received as `after` to resume from there.
+    """
+    stream = stream_ndjson(pool, AsyncSQLiteConnection.list_decks, lambda d: d.id, after, limit)
+    return ndjson_response(stream)
+
+
+@router.get("/export/sessions", response_class=StreamingResponse)
+async def export_sessions(
+    _: deps.DetachedSignedInAdmin,
+    pool: deps.DatabasePool,
+    after: str = "",
+    limit: PageLimit = None,
+):
+    """Stream sessions ordered by ULID as NDJSON.
+
+    Pass the ID of the last session received as `after` to resume from there.
+    """
+    stream = stream_ndjson(pool, AsyncSQLiteConnection.list_auth_sessions, lambda s: s.id, after, limit)
+    return ndjson_response(stream)
+
+
+@router.get("/stats")
+async def get_stats(_: deps.SignedInAdmin, request: Request) -> dict[str, dict]:
+    state = request.app.state
+    stats = {
+        "blocklist": state.blocklist.stats(),
+        "database_pool": state.db_pool.stats(),
+        "deck_cache": state.deck_cache.stats(),
+        "password_hasher": state.password_hasher.stats(),
+        "rate_limits": state.rate_limits.stats(),
+        "request_log": state.request_log.stats(),
+    }
+    if state.db_read_pool is not state.db_pool:
+        stats["database_read_pool"] = state.db_read_pool.stats()
+    return stats
@@ -7,20 +7,8 @@ import secrets
 from datetime import datetime, timedelta
 from typing import Annotated, Optional
 
-from fastapi import (
-    APIRouter,
-    BackgroundTasks,
-    Form,
-    Header,
-    HTTPException,
-    Query,
-    Request,
-    Response,
-    status,
-)
+from fastapi import APIRouter, Form, Header, HTTPException, Path, Query, Request, Response, status
 from florapi import utc_now
-from florapi.security import RateLimiter
-from passlib.context import CryptContext
 from pydantic import BaseModel
 from ulid import ULID
 
@@ -31,16 +19,16 @@ from ..constants import (
     MAX_SESSIONS,
     REFRESH_COOKIE_NAME,
     SESSION_LIFETIME,
-    SESSION_PURGE_DELTA,
     TLS_ENABLED,
 )
+from ..database import ConnectionPool
 from ..models import AuthSession, User
 from ..models import modelfields as mf
+from ..ratelimit import RateLimiter
 
 AccessToken = str
 
 logger = logging.getLogger(__name__)
-passlib_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 router = APIRouter(tags=["auth"])
 
 
@@ -66,14 +54,18 @@ class UserUpdateTemplate(BaseModel):
     password: str = mf.Password(default="")
 
 
-def authenticate_user(username: str, password: str, db) -> Optional[User]:
-    user = db.get_user(username)
-    if user and passlib_context.verify(password, user.hashed_password):
+async def authenticate_user(
+    username: str, password: str, pool: ConnectionPool, passwords: deps.Passwords
+) -> Optional[User]:
+    # Don't hold onto a pooled connection while bcrypt runs.
+    async with pool.connection() as db:
+        user = await db.get_user(username)
+    if user and await passwords.verify(password, user.hashed_password):
         return user
     return None
 
 
-def add_auth_session(
+async def add_auth_session(
     db: deps.DBConnection,
     username: str,
     access_lifetime: timedelta = ACCESS_TOKEN_LIFETIME,
@@ -88,16 +80,15 @@ def add_auth_session(
     access_expiry = utc_now() + access_lifetime
     refresh_token = "R:" + secrets.token_hex()
     refresh_expiry = utc_now() + session_lifetime
-    with db:
-        db.insert(
-            "sessions",
-            ("id", "username", "refresh_token", "refresh_expiry", "access_token", "access_expiry", "created_at"),
-            (ULID(), username, refresh_token, refresh_expiry, access_token, access_expiry, utc_now()),
-        )
-    return db.get_auth_session(access=access_token)
+    await db.insert(
+        "sessions",
+        ("id", "username", "refresh_token", "refresh_expiry", "access_token", "access_expiry", "created_at"),
+        (ULID(), username, refresh_token, refresh_expiry, access_token, access_expiry, utc_now()),
+    )
+    return await db.get_auth_session(access=access_token)
 
 
-def refresh_auth_session(
+async def refresh_auth_session(
     db: deps.DBConnection,
     refresh_token: str,
     access_lifetime: timedelta = ACCESS_TOKEN_LIFETIME
@@ -105,22 +96,22 @@ def refresh_auth_session(
     """Regenerate a new access token for a pre-existing session (refresh token)."""
     access_token = "A:" + secrets.token_hex()
     access_expiry = utc_now() + access_lifetime
-    with db:
-        db.update(
-            "sessions", {"access_token": access_token, "access_expiry": access_expiry},
-            where={"refresh_token": refresh_token}
-        )
+    await db.update(
+        "sessions", {"access_token": access_token, "access_expiry": access_expiry},
+        where={"refresh_token": refresh_token}
+    )
     return access_token
 
 
-async def purge_expired_sessions(purge_delta: timedelta, db: deps.DBConnection) -> None:
-    with db:
-        for session in db.get_auth_sessions(username=None):
-            if (session.refresh_expiry + purge_delta) < utc_now():
-                id = session.refresh_token
-                created_at = session.created_at.strftime("%Y-%m-%d %H:%M:%S")
-                logger.info(f"Purging session ({session.username}) from {created_at} - {id}")
-                db.delete("sessions", {"refresh_token": id})
+async def sweep_expired_sessions(pool: ConnectionPool, purge_delta: timedelta) -> None:
+    """Delete sessions whose refresh token expired more than purge_delta ago.
+
+    This is run periodically from the app's lifespan.
+    """
+    async with pool.connection() as db:
+        count = await db.purge_expired_sessions(utc_now() - purge_delta)
+    if count:
+        logger.info(f"Purged {count} expired session(s)")
 
 
 @router.post("/signup", status_code=201)
@@ -129,32 +120,36 @@ async def create_new_user(
     password: Annotated[str, Form(**mf.Password)],
     display_name: Annotated[str, Form(**mf.DisplayName)],
     challenge: Annotated[int, Query(gt=25, lt=27)],
-    db: deps.DBConnection,
+    pool: deps.DatabasePool,
+    passwords: deps.Passwords,
+    rate_limits: deps.RateLimits,
     request: Request,
     response: Response,
-    background_tasks: BackgroundTasks,
 ) -> AccessToken:
     if not ALLOW_NEW_USERS:
         raise HTTPException(403, "User sign-ups are currently disabled")
 
-    limiter = RateLimiter("signup", {RateLimiter.DAY: 5}, db)
+    limiter = RateLimiter("signup", {RateLimiter.DAY: 5}, rate_limits)
     if limiter.update_and_check(request.client.host):
         raise HTTPException(429)
 
     username = username.lower()
-    if db.get_user(username) is not None:
-        raise HTTPException(status_code=400, detail="Username already exists!")
-
-    with db:
-        db.insert("users", {
+    passwords.check_capacity()
+    async with pool.connection() as db:
+        if await db.get_user(username) is not None:
+            raise HTTPException(status_code=400, detail="Username already exists!")
+
+    hashed_password = await passwords.hash(password)
+    async with pool.connection() as db:
+        await db.insert("users", {
             "username": username,
-            "hashed_password": passlib_context.hash(password),
+            "hashed_password": hashed_password,
             "display_name": display_name,
             "is_admin": False,
             "created_at": utc_now(),
         })
     return await login_for_access_token(
-        username, password, "no-csrf-here", db, request, response, background_tasks
+        username, password, "no-csrf-here", pool, passwords, rate_limits, request, response
     )
 
 
@@ -163,10 +158,11 @@ async def login_for_access_token(
     username: Annotated[str, Form()],
     password: Annotated[str, Form()],
     x_csrf_protection: Annotated[str, Header()],
-    db: deps.DBConnection,
+    pool: deps.DatabasePool,
+    passwords: deps.Passwords,
+    rate_limits: deps.RateLimits,
     request: Request,
     response: Response,
-    background_tasks: BackgroundTasks,
 ) -> SignInResponse:
     """On sucessful login, return a new access token and set its associated (session)
     refresh cookie.
@@ -175,16 +171,17 @@ async def login_for_access_token(
     requiring authentication. It has a limited lifespan after which a client must request
     a new access token by calling `/session/refresh`.
     """
-    limiter = RateLimiter("login:failed-attempt", {RateLimiter.DAY: 10}, db)
+    limiter = RateLimiter("login:failed-attempt", {RateLimiter.DAY: 10}, rate_limits)
     if limiter.should_block(request.client.host) or limiter.should_block(username):
         raise HTTPException(429)
 
-    if user := authenticate_user(username, password, db):
-        if len(db.get_auth_sessions(username, include_expired=False)) >= MAX_SESSIONS:
-            raise HTTPException(429, detail="Too many registered sessions")
+    passwords.check_capacity()
+    if user := await authenticate_user(username, password, pool, passwords):
+        async with pool.connection() as db:
+            if await db.count_active_sessions(username) >= MAX_SESSIONS:
+                raise HTTPException(429, detail="Too many registered sessions")
 
-        background_tasks.add_task(purge_expired_sessions, SESSION_PURGE_DELTA, db)
-        session = add_auth_session(db, username)
+            session = await add_auth_session(db, username)
         response.set_cookie(
             REFRESH_COOKIE_NAME,
             session.refresh_token,
@@ -216,17 +213,16 @@ async def logout_session(
     # XXX: browser support for this header is quite limited, *sigh*
     # https://bugs.chromium.org/p/chromium/issues/detail?id=898503
     response.headers["Clear-Site-Data"] = '"cookies", "storage"'
-    with db:
-        db.delete("sessions", {"access_token": session.access_token})
+    await db.delete("sessions", {"access_token": session.access_token})
 
 
 @router.post("/session/refresh")
 async def refresh_session(session: deps.ValidRefreshCookie, db: deps.DBConnection) -> SignInResponse:
     """Generate a new access token for the current login session (as per the refresh cookie)."""
-    access_token = refresh_auth_session(db, session.refresh_token)
+    access_token = await refresh_auth_session(db, session.refresh_token)
     return SignInResponse(
-        session=db.get_auth_session(access=access_token),
-        user=db.get_user(session.username)
+        session=await db.get_auth_session(access=access_token),
+        user=await db.get_user(session.username)
     )
 
 
@@ -234,19 +230,18 @@ async def refresh_session(session: deps.ValidRefreshCookie, db: deps.DBConnectio
 async def list_sessions(
     actor: deps.SignedInUser, db: deps.DBConnection
 ) -> list[ExtraSanitizedAuthSession]:
-    return db.get_auth_sessions(username=actor.username)
+    return await db.get_auth_sessions(username=actor.username)
 
 
 @router.delete("/session/revoke/{id}")
 async def revoke_session(actor: deps.SignedInUser, id: str, db: deps.DBConnection) -> None:
     """Revoke (delete) a login session by ULID."""
-    session = db.get_auth_session(id=id)
+    session = await db.get_auth_session(id=id)
     if session is None:
         raise HTTPException(404, "Session not found")
 
     deps.check_for_resource_owner_or_admin(session.username, actor)
-    with db:
-        db.delete("sessions", {"access_token": session.access_token})
+    await db.delete("sessions", {"access_token": session.access_token})
 
 
 @router.get("/user")
@@ -262,18 +257,24 @@ async def get_user(actor: deps.SignedInUser, user: deps.ExistingUser) -> User:
 
 @router.patch("/user/{username}")
 async def update_user(
-    actor: deps.SignedInUser,
-    user: deps.ExistingUser,
+    actor: deps.DetachedSignedInUser,
+    username: Annotated[str, Path(max_length=20)],
     template: UserUpdateTemplate,
-    db: deps.DBConnection,
+    pool: deps.DatabasePool,
+    passwords: deps.Passwords,
+    cache: deps.DeckCache,
 ) -> None:
-    deps.check_for_resource_owner_or_admin(user.username, actor)
     update_data = template.dict(exclude_unset=True)
+    if update_data.get("password"):
+        passwords.check_capacity()
+    async with pool.connection() as db:
+        user = await deps.require_existing_username(username, db)
+    deps.check_for_resource_owner_or_admin(user.username, actor)
     if password := update_data.get("password"):
-        update_data["hashed_password"] = passlib_context.hash(password)
+        update_data["hashed_password"] = await passwords.hash(password)
     new_user = user.copy(update=update_data)
-    with db:
-        db.update(
+    async with pool.connection() as db:
+        await db.update(
             "users",
             {
                 "username": new_user.username,
@@ -282,11 +283,14 @@ async def update_user(
             },
             where={"username": user.username}
         )
+    if new_user.username != user.username:
+        # Renaming a user changes the owner of all of their decks.
+        for deck_id in user.decks:
+            cache.invalidate(deck_id)
 
 
 @router.delete("/user/{username}")
 async def delete_user(actor: deps.SignedInUser, user: deps.ExistingUser, db: deps.DBConnection) -> None:
     """Delete user from DB, not including owned decks."""
     deps.check_for_resource_owner_or_admin(user.username, actor)
-    with db:
-        db.delete("users", {"username": user.username})
+    await db.delete("users", {"username": user.username})
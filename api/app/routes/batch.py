@@ -0,0 +1,173 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from typing import Annotated, Literal, Optional, Union
+
+from fastapi import APIRouter, Response
+from florapi import utc_now
+from pydantic import BaseModel, Field
+
+from .. import dependencies as deps
+from ..database import SQLiteConnection
+from ..models import CardID, DeckID, UserInDB
+from ..models import modelfields as mf
+
+router = APIRouter(prefix="/deck", tags=["deck"])
+
+
+class AddCard(BaseModel):
+    op: Literal["add_card"]
+    deck_id: DeckID
+    term: str = mf.Card.Term
+    definition: str = mf.Card.Definition
+
+
+class UpdateCard(BaseModel):
+    op: Literal["update_card"]
+    card_id: CardID
+    term: str = mf.Card.Term(default="")
+    definition: str = mf.Card.Definition(default="")
+
+
+class DeleteCard(BaseModel):
+    op: Literal["delete_card"]
+    card_id: CardID
+
+
+class UpdateDeck(BaseModel):
+    op: Literal["update_deck"]
+    deck_id: DeckID
+    name: str = mf.Deck.Name(default="")
+    description: str = mf.Deck.Description(default="")
+    public: bool = False
+
+
+Operation = Annotated[Union[AddCard, UpdateCard, DeleteCard, UpdateDeck], Field(discriminator="op")]
+
+
+class BatchTemplate(BaseModel):
+    operations: list[Operation] = Field(max_items=200)
+
+
+class OperationResult(BaseModel):
+    ok: bool
+    status: int
+    detail: Optional[str] = None
+    card_id: Optional[CardID] = None
+
+
+class BatchRejected(Exception):
+    def __init__(self, results: list[OperationResult]) -> None:
+        super().__init__(results)
+        self.results = results
+
+
+def apply_batch(
+    db: SQLiteConnection, actor: UserInDB, operations: list[Operation]
+) -> tuple[list[OperationResult], set[DeckID]]:
+    """Validate and apply a batch of operations (in the caller's transaction).
+
+    Everything needed for validation is loaded upfront with a fixed number of queries
+    and ownership is checked once per deck. If any operation is invalid, nothing is
+    written and BatchRejected is raised with the per-operation results.
+    """
+    card_ids = [op.card_id for op in operations if isinstance(op, (UpdateCard, DeleteCard))]
+    placeholders = ", ".join("?" * len(card_ids))
+    cur = db.execute(f"SELECT id, deck_id FROM cards WHERE id IN ({placeholders});", card_ids)
+    cards = {str(row["id"]): row["deck_id"] for row in cur}
+    deck_ids = {op.deck_id for op in operations if isinstance(op, (AddCard, UpdateDeck))}
+    deck_ids.update(cards.values())
+    decks = {v.id: v for v in db.get_deck_versions(deck_ids)}
+    placeholders = ", ".join("?" * len(decks))
+    card_counts = dict.fromkeys(decks, 0)
+    card_counts.update(db.execute(
+        f"SELECT deck_id, COUNT(*) FROM cards WHERE deck_id IN ({placeholders}) GROUP BY deck_id;",
+        list(decks),
+    ).fetchall())
+
+    errors: dict[int, OperationResult] = {}
+    deleted: set[CardID] = set()
+    for i, op in enumerate(operations):
+        if isinstance(op, (UpdateCard, DeleteCard)):
+            if op.card_id not in cards or op.card_id in deleted:
+                errors[i] = OperationResult(ok=False, status=404, detail="Card not found")
+                continue
+            deck_id = cards[op.card_id]
+        else:
+            deck_id = op.deck_id
+        if (deck := decks.get(deck_id)) is None:
+            errors[i] = OperationResult(ok=False, status=404, detail="Deck not found")
+        elif not actor.is_admin and deck.owner != actor.username:
+            errors[i] = OperationResult(
+                ok=False, status=403, detail="Resource does not belong to you."
+            )
+        elif isinstance(op, AddCard):
+            card_counts[deck_id] += 1
+            if card_counts[deck_id] > 100:
+                errors[i] = OperationResult(
+                    ok=False, status=400, detail="Deck can only contain up to 100 cards"
+                )
+        elif isinstance(op, DeleteCard):
+            card_counts[deck_id] -= 1
+            deleted.add(op.card_id)
+    if errors:
+        raise BatchRejected([
+            errors.get(i, OperationResult(ok=False, status=424, detail="Not applied"))
+            for i in range(len(operations))
+        ])
+
+    results = []
+    touched = set()
+    for op in operations:
+        if isinstance(op, AddCard):
+            cur = db.execute(
+                "INSERT INTO cards (deck_id, term, definition) VALUES (?, ?, ?);",
+                [op.deck_id, op.term, op.definition],
+            )
+            results.append(OperationResult(ok=True, status=201, card_id=cur.lastrowid))
+            touched.add(op.deck_id)
+        elif isinstance(op, UpdateCard):
+            changes = op.dict(exclude_unset=True, exclude={"op", "card_id"})
+            if changes:
+                db.update("cards", changes, where={"id": op.card_id})
+            results.append(OperationResult(ok=True, status=200, card_id=op.card_id))
+            touched.add(cards[op.card_id])
+        elif isinstance(op, DeleteCard):
+            db.delete("cards", {"id": op.card_id})
+            results.append(OperationResult(ok=True, status=200, card_id=op.card_id))
+            touched.add(cards[op.card_id])
+        else:
+            changes = op.dict(exclude_unset=True, exclude={"op", "deck_id"})
+            if changes:
+                db.update("decks", changes, where={"id": op.deck_id})
+            results.append(OperationResult(ok=True, status=200))
+            touched.add(op.deck_id)
+    now = utc_now()
+    for deck_id in touched:
+        db.update("decks", {"updated_at": now}, where={"id": deck_id})
+    return results, touched
+
+
+@router.post("/batch")
+async def batch_update(
+    actor: deps.SignedInUser,
+    template: BatchTemplate,
+    db: deps.DBConnection,
+    cache: deps.DeckCache,
+    response: Response,
+) -> list[OperationResult]:
+    """Apply several card and deck operations atomically, in a single transaction.
+
+    Returns one result per operation. If any operation fails validation, nothing is
+    applied, the response status is 400, and the remaining operations are marked 424.
+    """
+    try:
+        results, touched = await db.transaction(apply_batch, actor, template.operations)
+    except BatchRejected as e:
+        response.status_code = 400
+        return e.results
+
+    for deck_id in touched:
+        cache.invalidate(deck_id)
+    return results
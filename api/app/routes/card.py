@@ -7,6 +7,7 @@ from florapi import utc_now
 from pydantic import BaseModel
 
 from .. import dependencies as deps
+from ..database import SQLiteConnection
 from ..models import modelfields as mf
 
 router = APIRouter(prefix="/card", tags=["deck"])
@@ -22,22 +23,34 @@ async def update_card(
     actor: deps.SignedInUser,
     card_and_deck: deps.ExistingCard,
     template: CardUpdateTemplate,
-    db: deps.DBConnection
+    db: deps.DBConnection,
+    cache: deps.DeckCache,
 ) -> None:
     card, deck = card_and_deck
     deps.check_for_resource_owner_or_admin(deck.owner, actor)
     card = card.copy(update=template.dict(exclude_unset=True))
-    with db:
-        db.update("cards", {"term": card.term, "definition": card.definition}, where={"id": card.id})
-        db.update("decks", {"updated_at": utc_now()}, where={"id": deck.id})
+
+    def apply(con: SQLiteConnection) -> None:
+        con.update("cards", {"term": card.term, "definition": card.definition}, where={"id": card.id})
+        con.update("decks", {"updated_at": utc_now()}, where={"id": deck.id})
+
+    await db.transaction(apply)
+    cache.invalidate(deck.id)
 
 
 @router.delete("/{card_id}")
 async def delete_card(
-    actor: deps.SignedInUser, card_and_deck: deps.ExistingCard, db: deps.DBConnection
+    actor: deps.SignedInUser,
+    card_and_deck: deps.ExistingCard,
+    db: deps.DBConnection,
+    cache: deps.DeckCache,
 ) -> None:
     card, deck = card_and_deck
     deps.check_for_resource_owner_or_admin(deck.owner, actor)
-    with db:
-        db.delete("cards", {"id": card.id})
-        db.update("decks", {"updated_at": utc_now()}, where={"id": deck.id})
+
+    def apply(con: SQLiteConnection) -> None:
+        con.delete("cards", {"id": card.id})
+        con.update("decks", {"updated_at": utc_now()}, where={"id": deck.id})
+
+    await db.transaction(apply)
+    cache.invalidate(deck.id)
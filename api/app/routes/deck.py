@@ -2,15 +2,21 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from fastapi import APIRouter, HTTPException
+from typing import Annotated, NamedTuple, Optional
+
+from fastapi import APIRouter, Header, HTTPException, Response
 from florapi import utc_now
 from pydantic import BaseModel, Field, validator
 
 from .. import dependencies as deps
-from ..models import CardTemplate, Deck, DeckID
+from ..caching import deck_etag, deck_library_etag, etag_matches
+from ..database import SQLiteConnection
+from ..models import Card, CardID, CardTemplate, Deck, DeckID
 from ..models import modelfields as mf
+from ..utils import dump_json
 
 router = APIRouter(prefix="/deck", tags=["deck"])
+IfNoneMatch = Annotated[Optional[str], Header()]
 
 
 class DeckTemplate(BaseModel):
@@ -26,46 +32,142 @@ class DeckTemplate(BaseModel):
         return v
 
 
+class CardDiffTemplate(CardTemplate):
+    id: Optional[CardID] = None
+
+
 class DeckUpdateTemplate(DeckTemplate):
     name: str = mf.Deck.Name(default="")
     description: str = mf.Deck.Description(default="")
-    cards: list[CardTemplate] = Field(default_factory=list)
+    cards: list[CardDiffTemplate] = Field(default_factory=list)
+
+
+class CardDiff(NamedTuple):
+    modified: list[Card]
+    removed: list[CardID]
+    added: list[CardTemplate]
+
+
+def diff_cards(stored: list[Card], wanted: list[CardDiffTemplate]) -> CardDiff:
+    """Compute the card writes needed to turn the stored cards into the wanted ones.
+
+    Cards are ordered by ID and new rows always get a higher ID, so only the longest
+    prefix of existing cards (in ascending ID order) can stay where it is. Those are
+    updated in place if changed, everything after the prefix is (re)inserted, and any
+    other stored card is removed.
+    """
+    by_id = {c.id: c for c in stored}
+    seen = set()
+    for c in wanted:
+        if c.id is None:
+            continue
+        if c.id not in by_id:
+            raise ValueError(f"Card {c.id} does not belong to this deck")
+        if c.id in seen:
+            raise ValueError(f"Card {c.id} is listed more than once")
+        seen.add(c.id)
+
+    kept: list[CardDiffTemplate] = []
+    for c in wanted:
+        if c.id is None or (kept and int(c.id) <= int(kept[-1].id)):
+            break
+        kept.append(c)
+    modified = [
+        Card(id=c.id, term=c.term, definition=c.definition)
+        for c in kept
+        if (c.term, c.definition) != (by_id[c.id].term, by_id[c.id].definition)
+    ]
+    kept_ids = {c.id for c in kept}
+    removed = [c.id for c in stored if c.id not in kept_ids]
+    return CardDiff(modified, removed, wanted[len(kept):])
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def json_response(body: bytes, etag: str, cache_control: str) -> Response:
+    # Returning a Response also skips FastAPI's revalidation against the response model.
+    return Response(
+        body, media_type="application/json", headers={"ETag": etag, "Cache-Control": cache_control}
+    )
 
 
 @router.get("/library")
-async def get_deck_library(actor: deps.SignedInUser, db: deps.DBConnection) -> list[Deck]:
-    return [db.get_deck(id) for id in actor.decks]
+async def get_deck_library(
+    actor: deps.SignedInUser,
+    db: deps.DBConnection,
+    if_none_match: IfNoneMatch = None,
+) -> list[Deck]:
+    if if_none_match:
+        etag = deck_library_etag(await db.get_deck_versions(actor.decks))
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag, "private, no-cache")
+
+    decks = await db.get_decks(actor.decks)
+    return json_response(dump_json(decks), deck_library_etag(decks), "private, no-cache")
 
 
 @router.post("/new", status_code=201)
 async def create_deck(actor: deps.SignedInUser, t: DeckTemplate, db: deps.DBConnection) -> DeckID:
-    deck_library = await get_deck_library(actor, db)
+    deck_library = await db.get_decks(actor.decks)
     if len(deck_library) >= 50:
         raise HTTPException(400, detail="Reached maximum deck count")
 
-    with db:
-        db.insert("decks", {
+    def apply(con: SQLiteConnection) -> DeckID:
+        con.insert("decks", {
             "owner": actor.username,
             "name": t.name,
             "description": t.description,
             "created_at": utc_now(), "updated_at": utc_now(), "accessed_at": utc_now(),
             "public": t.public
         })
-        deck_id = db.execute("SELECT id FROM decks ORDER BY id DESC LIMIT 1;").fetchone()[0]
-        db.insert_many(
+        deck_id = con.execute("SELECT id FROM decks ORDER BY id DESC LIMIT 1;").fetchone()[0]
+        con.insert_many(
             "cards", ("deck_id", "term", "definition"),
             [(deck_id, c.term, c.definition) for c in t.cards]
         )
-    return deck_id
+        return deck_id
+
+    return await db.transaction(apply)
 
 
 @router.get("/{deck_id}")
-async def get_deck(actor: deps.MaybeSignedInUser, deck: deps.ExistingDeck) -> Deck:
-    if not deck.public:
+async def get_deck(
+    actor: deps.MaybeSignedInUser,
+    version: deps.ExistingDeckVersion,
+    db: deps.DBConnection,
+    cache: deps.DeckCache,
+    if_none_match: IfNoneMatch = None,
+) -> Deck:
+    """Return a deck.
+
+    Supports conditional requests: if the deck hasn't changed since the ETag passed in
+    If-None-Match, 304 Not Modified is returned without loading any cards.
+    """
+    if not version.public:
         if actor is None:
             deps.raise_credentials_error()
-        deps.check_for_resource_owner_or_admin(deck.owner, actor)
-    return deck
+        deps.check_for_resource_owner_or_admin(version.owner, actor)
+    cache_control = "no-cache" if version.public else "private, no-cache"
+    if etag_matches(if_none_match, etag := deck_etag(version)):
+        return not_modified(etag, cache_control)
+
+    if version.public and (body := cache.get(version.id, etag)):
+        return json_response(body, etag, cache_control)
+
+    deck = await db.get_deck(version.id)
+    if deck is None:
+        raise HTTPException(status_code=404, detail="Deck not found")
+
+    # The ETag is derived from the loaded deck in case it changed in the meantime.
+    etag = deck_etag(deck)
+    if deck.public:
+        body = dump_json(deck)
+        cache.put(deck.id, etag, body)
+        return json_response(body, etag, cache_control)
+
+    return json_response(dump_json(deck), etag, cache_control)
 
 
 @router.patch("/{deck_id}")
@@ -74,16 +176,26 @@ async def update_deck(
     original_deck: deps.ExistingDeck,
     template: DeckUpdateTemplate,
     db: deps.DBConnection,
+    cache: deps.DeckCache,
+    diff: bool = False,
 ) -> None:
     """Update a deck. Partial updates are somewhat supported.
 
-    (*) Cards must be replaced with a new complete list at the moment unfortunately.
+    By default, cards must be replaced with a new complete list. With `diff=true`,
+    cards may carry the `id` of an existing card and only the cards that were added,
+    modified, removed or reordered are written. Omitting `cards` leaves them as is.
     """
     deps.check_for_resource_owner_or_admin(original_deck.owner, actor)
+    if diff:
+        await update_deck_diff(original_deck, template, db)
+        cache.invalidate(original_deck.id)
+        return
+
     d = original_deck.copy(update=template.dict(exclude_unset=True))
-    with db:
-        db.delete("cards", {"deck_id": original_deck.id})
-        db.update("decks", {
+
+    def apply(con: SQLiteConnection) -> None:
+        con.delete("cards", {"deck_id": original_deck.id})
+        con.update("decks", {
                 "name": d.name,
                 "description": d.description,
                 "updated_at": utc_now(),
@@ -91,23 +203,69 @@ async def update_deck(
             },
             where={"id": original_deck.id}
         )
-        db.insert_many(
+        con.insert_many(
             "cards", ("deck_id", "term", "definition"),
             [(original_deck.id, c.term, c.definition) for c in template.cards]
         )
 
+    await db.transaction(apply)
+    cache.invalidate(original_deck.id)
+
+
+async def update_deck_diff(
+    original_deck: Deck, template: DeckUpdateTemplate, db: deps.DBConnection
+) -> None:
+    changes = template.dict(exclude_unset=True, exclude={"cards"})
+    deck_changes = {k: v for k, v in changes.items() if getattr(original_deck, k) != v}
+    update_cards = "cards" in template.__fields_set__
+    if not deck_changes and not update_cards:
+        return
+
+    def apply(con: SQLiteConnection) -> None:
+        card_diff = CardDiff([], [], [])
+        if update_cards:
+            # Diff against the cards as they are now: other requests may have changed them
+            # since the deck was loaded.
+            cur = con.execute(
+                "SELECT * FROM cards WHERE deck_id = ? ORDER BY id;", [original_deck.id]
+            )
+            try:
+                card_diff = diff_cards([Card.from_row(row) for row in cur], template.cards)
+            except ValueError as e:
+                raise HTTPException(400, detail=str(e))
+        if not deck_changes and not any(card_diff):
+            return
+
+        if card_diff.removed:
+            con.executemany("DELETE FROM cards WHERE id = ?;", [(id,) for id in card_diff.removed])
+        if card_diff.modified:
+            con.executemany(
+                "UPDATE cards SET term = ?, definition = ? WHERE id = ?;",
+                [(c.term, c.definition, c.id) for c in card_diff.modified],
+            )
+        if card_diff.added:
+            con.insert_many(
+                "cards", ("deck_id", "term", "definition"),
+                [(original_deck.id, c.term, c.definition) for c in card_diff.added]
+            )
+        con.update("decks", {**deck_changes, "updated_at": utc_now()}, where={"id": original_deck.id})
+
+    await db.transaction(apply)
+
 
 @router.delete("/{deck_id}")
 async def delete_deck(
-    actor: deps.SignedInUser, deck: deps.ExistingDeck, db: deps.DBConnection
+    actor: deps.SignedInUser, deck: deps.ExistingDeck, db: deps.DBConnection, cache: deps.DeckCache
 ) -> None:
     deps.check_for_resource_owner_or_admin(deck.owner, actor)
-    with db:
-        db.delete("decks", {"id": deck.id})
+    await db.delete("decks", {"id": deck.id})
+    cache.invalidate(deck.id)
 
 
 @router.post("/{deck_id}/accessed")
-async def bump_deck(actor: deps.SignedInUser, deck: deps.ExistingDeck, db: deps.DBConnection) -> None:
+async def bump_deck(
+    actor: deps.SignedInUser, deck: deps.ExistingDeck, db: deps.DBConnection, cache: deps.DeckCache
+) -> None:
     deps.check_for_resource_owner_or_admin(deck.owner, actor)
-    with db:
-        db.update("decks", {"accessed_at": utc_now()}, where={"id": deck.id})
+    await db.update("decks", {"accessed_at": utc_now()}, where={"id": deck.id})
+    cache.invalidate(deck.id)
@@ -0,0 +1,165 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""The database schema, as an ordered list of migrations.
+
+The schema version is tracked with `PRAGMA user_version`. Migrations are only ever
+appended to: `migrate()` applies the ones a database hasn't seen yet, in order, each
+in its own transaction. Run `python -m app.schema` to migrate the configured
+database and check the query plans of the hot-path queries.
+"""
+
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS: list[str] = [
+    # 1: Baseline schema. Existing databases already have these tables.
+    """
+    CREATE TABLE IF NOT EXISTS "users" (
+        "username"         TEXT PRIMARY KEY NOT NULL,
+        "hashed_password"  TEXT NOT NULL,
+        "display_name"     TEXT,
+        "is_admin"         INTEGER NOT NULL DEFAULT 0,
+        "created_at"       TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS "decks" (
+        "id"               INTEGER PRIMARY KEY AUTOINCREMENT,
+        "name"             TEXT NOT NULL,
+        "description"      TEXT NOT NULL,
+        "owner"            TEXT,
+        "public"           INTEGER NOT NULL DEFAULT 0,
+        "created_at"       TEXT NOT NULL,
+        "updated_at"       TEXT NOT NULL,
+        "accessed_at"      TEXT NOT NULL,
+        FOREIGN KEY("owner") REFERENCES "users"("username") ON UPDATE CASCADE
+    );
+    CREATE TABLE IF NOT EXISTS "cards" (
+        "id"               INTEGER PRIMARY KEY NOT NULL,
+        "deck_id"          INTEGER NOT NULL,
+        "term"             TEXT NOT NULL,
+        "definition"       TEXT NOT NULL,
+        FOREIGN KEY("deck_id") REFERENCES "decks"("id") ON DELETE CASCADE
+    );
+    CREATE TABLE IF NOT EXISTS "requests" (
+        "datetime"   TEXT PRIMARY KEY NOT NULL,
+        "ip"         TEXT,
+        "useragent"  TEXT,
+        "referer"    TEXT,
+        "verb"       TEXT NOT NULL,
+        "path"       TEXT NOT NULL,
+        "status"     INTEGER NOT NULL,
+        "duration"   REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS "sessions" (
+        "id"              TEXT NOT NULL UNIQUE,
+        "username"        TEXT NOT NULL,
+        "refresh_token"   TEXT PRIMARY KEY NOT NULL,
+        "refresh_expiry"  TEXT NOT NULL,
+        "access_token"    TEXT NOT NULL UNIQUE,
+        "access_expiry"   TEXT NOT NULL,
+        "created_at"      TEXT NOT NULL,
+        FOREIGN KEY("username") REFERENCES "users"("username")
+          ON UPDATE CASCADE ON DELETE CASCADE
+    );
+    CREATE TABLE IF NOT EXISTS "_ratelimits" (
+        "key"       TEXT NOT NULL,
+        "duration"  INTEGER NOT NULL,
+        "value"     INTEGER NOT NULL,
+        "expiry"    TEXT NOT NULL,
+        PRIMARY KEY("key", "expiry")
+    );
+    """,
+    # 2: Indexes for the columns filtered on by (almost) every authenticated request.
+    # The session token and ID columns are already covered by their UNIQUE constraints.
+    """
+    CREATE INDEX IF NOT EXISTS "sessions_username_refresh_expiry" ON "sessions" ("username", "refresh_expiry");
+    CREATE INDEX IF NOT EXISTS "sessions_refresh_expiry" ON "sessions" ("refresh_expiry");
+    CREATE INDEX IF NOT EXISTS "decks_owner" ON "decks" ("owner");
+    CREATE INDEX IF NOT EXISTS "cards_deck_id" ON "cards" ("deck_id");
+    """,
+    # 3: Rate limit counters are per (key, duration, window), so a limiter with several
+    # durations whose windows end at the same time doesn't overwrite its own counters.
+    """
+    CREATE TABLE "_ratelimits_new" (
+        "key"       TEXT NOT NULL,
+        "duration"  INTEGER NOT NULL,
+        "value"     INTEGER NOT NULL,
+        "expiry"    TEXT NOT NULL,
+        PRIMARY KEY("key", "duration", "expiry")
+    );
+    INSERT INTO "_ratelimits_new" SELECT "key", "duration", "value", "expiry" FROM "_ratelimits";
+    DROP TABLE "_ratelimits";
+    ALTER TABLE "_ratelimits_new" RENAME TO "_ratelimits";
+    """,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Queries that run on hot paths and must never scan a whole table.
+HOT_QUERIES: dict[str, str] = {
+    "user by username": "SELECT * FROM users WHERE username = ?;",
+    "decks by owner": "SELECT id FROM decks WHERE owner = ?;",
+    "deck by id": "SELECT * FROM decks WHERE id = ?;",
+    "cards by deck": "SELECT * FROM cards WHERE deck_id = ? ORDER BY id;",
+    "card by id": "SELECT * FROM cards WHERE id = ?;",
+    "session by access token": "SELECT * FROM sessions WHERE access_token = ?;",
+    "session by refresh token": "SELECT * FROM sessions WHERE refresh_token = ?;",
+    "session by id": "SELECT * FROM sessions WHERE id = ?;",
+    "sessions by username": "SELECT * FROM sessions WHERE username = ?;",
+    "active session count": "SELECT COUNT(*) FROM sessions WHERE username = ? AND refresh_expiry > ?;",
+    "expired session purge": "DELETE FROM sessions WHERE refresh_expiry < ?;",
+}
+
+
+def get_schema_version(db: sqlite3.Connection) -> int:
+    return db.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def migrate(db: sqlite3.Connection) -> int:
+    """Upgrade the database schema in place. Return the number of migrations applied."""
+    version = get_schema_version(db)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"database schema (v{version}) is newer than this version of the app (v{SCHEMA_VERSION})"
+        )
+
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        # executescript() would otherwise commit after each statement.
+        db.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+        logger.info(f"Applied database migration {number}/{SCHEMA_VERSION}")
+    return SCHEMA_VERSION - version
+
+
+def find_unindexed_queries(db: sqlite3.Connection) -> dict[str, list[str]]:
+    """Return the hot queries whose plan includes a full table scan (with the plan)."""
+    unindexed = {}
+    for name, sql in HOT_QUERIES.items():
+        params = [None] * sql.count("?")
+        plan = [row[3] for row in db.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        if any(step.startswith("SCAN ") and " USING " not in step for step in plan):
+            unindexed[name] = plan
+    return unindexed
+
+
+def main() -> None:
+    from .database import open_sqlite_connection
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    db = open_sqlite_connection()
+    try:
+        migrate(db)
+        print(f"Schema version: {get_schema_version(db)}")
+        unindexed = find_unindexed_queries(db)
+        for name, plan in unindexed.items():
+            print(f"UNINDEXED: {name}: {'; '.join(plan)}")
+        if not unindexed:
+            print(f"All {len(HOT_QUERIES)} hot queries use an index.")
+    finally:
+        db.close()
+    raise SystemExit(1 if unindexed else 0)
+
+
+if __name__ == "__main__":
+    main()
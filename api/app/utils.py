@@ -2,10 +2,23 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import asyncio
+import json
 import logging
+from datetime import timedelta
+from typing import Awaitable, Callable
 
 import click
 import uvicorn.logging
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
 
 
 class AppLogFormatter(uvicorn.logging.DefaultFormatter):
@@ -13,3 +26,45 @@ class AppLogFormatter(uvicorn.logging.DefaultFormatter):
         if self.use_colors:
             record.name = click.style(record.name, dim=True)
         return super().formatMessage(record)
+
+
+def run_periodically(
+    interval: timedelta, fn: Callable[..., Awaitable[object]], *args: object
+) -> "asyncio.Task[None]":
+    """Schedule `await fn(*args)` to run every interval until the returned task is cancelled.
+
+    Exceptions are logged and don't stop future runs.
+    """
+    async def loop() -> None:
+        while True:
+            await asyncio.sleep(interval.total_seconds())
+            try:
+                await fn(*args)
+            except Exception:
+                logger.exception(f"Periodic task {fn.__qualname__} failed")
+
+    return asyncio.create_task(loop(), name=f"periodic:{fn.__qualname__}")
+
+
+async def cancel_task(task: "asyncio.Task[object]") -> None:
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def _orjson_default(obj: object) -> object:
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
+
+
+def dump_json(content: object) -> bytes:
+    """Serialize models (or containers of them) to compact JSON.
+
+    orjson is used if it's installed as it's several times faster on large decks.
+    """
+    if orjson is not None:
+        return orjson.dumps(content, default=_orjson_default)
+    return json.dumps(content, default=pydantic_encoder, separators=(",", ":")).encode()
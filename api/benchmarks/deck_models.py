@@ -0,0 +1,83 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Compare the validated and trusted paths for loading and serializing a 100-card deck.
+
+The validated path is what GET /deck/{id} used to do: build the models with full
+validation, then let FastAPI revalidate and encode the return value. The trusted path
+uses Deck.from_row() and dump_json(). Run from the api directory:
+
+    python -m benchmarks.deck_models [--number N]
+"""
+
+import argparse
+import functools
+import json
+import sqlite3
+import timeit
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+
+from app.models import Deck
+from app.schema import migrate
+from app.utils import dump_json, orjson
+
+
+def setup_database(card_count: int) -> sqlite3.Connection:
+    db = sqlite3.connect(":memory:")
+    db.row_factory = sqlite3.Row
+    migrate(db)
+    now = datetime.now(timezone.utc).isoformat()
+    db.execute(
+        "INSERT INTO decks (id, name, description, owner, public, created_at, updated_at, accessed_at)"
+        " VALUES (1, 'Benchmark', 'A deck for benchmarking.', NULL, 1, ?, ?, ?);",
+        [now, now, now],
+    )
+    db.executemany(
+        "INSERT INTO cards (deck_id, term, definition) VALUES (1, ?, ?);",
+        [(f"term #{i}", f"the definition of term #{i}") for i in range(card_count)],
+    )
+    return db
+
+
+def fetch(db: sqlite3.Connection) -> tuple[sqlite3.Row, list[sqlite3.Row]]:
+    row = db.execute("SELECT * FROM decks WHERE id = 1;").fetchone()
+    cards = db.execute("SELECT * FROM cards WHERE deck_id = 1 ORDER BY id;").fetchall()
+    return row, cards
+
+
+def validated(db: sqlite3.Connection) -> bytes:
+    row, cards = fetch(db)
+    deck = Deck(**row, cards=cards)
+    # What FastAPI does with a returned model: validate it against the response model,
+    # then encode it with the default JSONResponse.
+    deck = Deck.validate(deck.dict())
+    return json.dumps(jsonable_encoder(deck)).encode()
+
+
+def trusted(db: sqlite3.Connection) -> bytes:
+    row, cards = fetch(db)
+    return dump_json(Deck.from_row(row, cards))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cards", type=int, default=100, help="Cards in the deck.")
+    parser.add_argument("--number", type=int, default=2000, help="Iterations per run.")
+    args = parser.parse_args()
+
+    db = setup_database(args.cards)
+    assert json.loads(validated(db)) == json.loads(trusted(db)), "the paths disagree"
+    print(f"{args.cards}-card deck, JSON via {'orjson' if orjson else 'json'}:")
+    results = {}
+    for name, fn in [("validated", validated), ("trusted", trusted)]:
+        best = min(timeit.repeat(functools.partial(fn, db), number=args.number, repeat=5))
+        results[name] = best / args.number * 1e6
+        print(f"  {name:>9}: {results[name]:8.1f} µs/deck")
+    print(f"  speed-up:  {results['validated'] / results['trusted']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,15 @@
 
 import dataclasses
 import smtplib
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from datetime import timedelta
 from email.message import EmailMessage
+from typing import Iterator
 
 from fastapi import FastAPI, Response
-from florapi.configuration import Options
+from florapi.configuration import Options, TimeDelta
 
 app_opt = Options("TMC_EMAIL")
 
@@ -16,11 +21,127 @@ SENDER_ADDRESS = app_opt("sender-address", type=str)
 SENDER_PASSWORD = app_opt("sender-password", type=str)
 REPLY_TO_ADDRESS = app_opt("reply-to", type=str)
 LOG_ADDRESS = app_opt("log-address", type=str)
+SMTP_HOST = app_opt("smtp-host", type=str, default="smtp.gmail.com")
+SMTP_PORT = app_opt("smtp-port", type=int, default=465)
+# Disable to talk plain SMTP to a local stand-in server (e.g. python -m aiosmtpd -n).
+SMTP_TLS = app_opt("smtp-tls", type=bool, default=True)
+SMTP_POOL_SIZE = app_opt("smtp-pool-size", type=int, default=2)
+SMTP_IDLE_TIMEOUT = app_opt("smtp-idle-timeout", type=TimeDelta, default="minutes=1")
 app_opt.report_errors()
 
+
+class SMTPPool:
+    """A pool of logged in SMTP sessions, reused across requests.
+
+    Sessions idle for longer than `idle_timeout` are closed instead of reused, and the
+    others are checked with NOOP first as servers drop idle clients. A session that
+    fails the check is replaced by a fresh one before anything is sent on it, so an
+    email is never retried (and possibly delivered twice) after its DATA went out.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        *,
+        tls: bool,
+        username: str,
+        password: str,
+        size: int,
+        idle_timeout: timedelta,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.username = username
+        self.password = password
+        self.idle_timeout = idle_timeout.total_seconds()
+        self.connects = 0
+        self._idle: list[tuple[smtplib.SMTP, float]] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def session(self) -> Iterator[smtplib.SMTP]:
+        with self._slots:
+            session = self._take_idle()
+            if session is None:
+                session = self._connect()
+            try:
+                yield session
+            except smtplib.SMTPResponseException:
+                # The server rejected something but the session itself is fine.
+                self._put_idle(session)
+                raise
+            except BaseException:
+                self._close(session)
+                raise
+            else:
+                self._put_idle(session)
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session, _ in idle:
+            self._close(session)
+
+    def _connect(self) -> smtplib.SMTP:
+        session_cls = smtplib.SMTP_SSL if self.tls else smtplib.SMTP
+        session = session_cls(self.host, self.port, timeout=30)
+        session.ehlo_or_helo_if_needed()
+        if session.has_extn("auth"):
+            session.login(self.username, self.password)
+        self.connects += 1
+        return session
+
+    def _take_idle(self) -> "smtplib.SMTP | None":
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                # Most recently used first, the others are left to time out.
+                session, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self.idle_timeout:
+                try:
+                    if session.noop()[0] == 250:
+                        return session
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self._close(session)
+
+    def _put_idle(self, session: smtplib.SMTP) -> None:
+        with self._lock:
+            self._idle.append((session, time.monotonic()))
+
+    @staticmethod
+    def _close(session: smtplib.SMTP) -> None:
+        try:
+            session.quit()
+        except (smtplib.SMTPException, OSError):
+            session.close()
+
+
+smtp_pool = SMTPPool(
+    SMTP_HOST,
+    SMTP_PORT,
+    tls=SMTP_TLS,
+    username=SENDER_ADDRESS,
+    password=SENDER_PASSWORD,
+    size=SMTP_POOL_SIZE,
+    idle_timeout=SMTP_IDLE_TIMEOUT,
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> None:
+    yield
+    smtp_pool.close()
+
+
 app = FastAPI(
     title="TooManyCards Email Service API",
     contact={"name": "Richard Si"},
+    lifespan=lifespan,
 )
 
 UnsuccessfulAddress = str
@@ -36,7 +157,7 @@ class Email:
 
 
 def _smtp_send_email(
-    smtp_session: smtplib.SMTP_SSL,
+    smtp_session: smtplib.SMTP,
     sender_address: str,
     reply_to_address: str,
     email: Email,
@@ -61,19 +182,24 @@ def _smtp_send_email(
     msg["From"] = f"{email.sender_name} <{sender_address}>"
     msg["To"] = ", ".join(email.recipients)
     msg["reply-to"] = reply_to_address
-    smtp_session.send_message(msg)
+    refused = smtp_session.send_message(msg)
     print(f"[outgoing {log=}] Mail '{email.subject}' sent to {', '.join(email.recipients)}")
+    return list(refused)
 
 
 @app.post("/send")
 def send_email_endpoint(emails: list[Email], response: Response, log: bool = True) -> object:
-    errors = []
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp_session:
-        smtp_session.login(SENDER_ADDRESS, SENDER_PASSWORD)
+    errors: list[UnsuccessfulAddress] = []
+    with smtp_pool.session() as smtp_session:
         for mail in emails:
-            errors.append(_smtp_send_email(smtp_session, SENDER_ADDRESS, REPLY_TO_ADDRESS, mail, log=log))
+            try:
+                errors += _smtp_send_email(
+                    smtp_session, SENDER_ADDRESS, REPLY_TO_ADDRESS, mail, log=log
+                )
+            except smtplib.SMTPRecipientsRefused as e:
+                # Nobody got this one, but the session is fine for the rest.
+                errors += e.recipients
 
-    errors = [e for e in errors if e is not None]
     if errors:
         response.status_code = 400
     return errors
@@ -2,20 +2,30 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import functools
+import gzip
 import http.client
+import ipaddress
+import json
+import os
 import re
+import shlex
 import subprocess
 import time
+from array import array
+from bisect import bisect_left
 from collections import Counter, defaultdict
-from dataclasses import dataclass
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import IO, Callable, Iterable, Iterator, NamedTuple, Optional, Union
 
 import click
 import rich
 
 NGINX_LOG_REGEX = re.compile(
-    r'''(?P<src>[0-9\.]+)
+    r'''(?P<src>[0-9A-Fa-f\.:]+)
         \s-\s-\s
         \[(?P<timestamp>.+)\]
         \s
@@ -32,73 +42,894 @@ NGINX_LOG_REGEX = re.compile(
 )
 console = rich.get_console()
 rprint = console.print
+# The largest byte range handed to a worker process with --jobs.
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+# Tags the firewall rules (and names the ipsets) managed by this script.
+FIREWALL_TAG = "tmc-blocklist"
+# Per IP version: the prefix treated as a single host (an IPv6 /64 is usually a single
+# subscriber) and the widest prefix suspicious addresses are ever aggregated into.
+CIDR_LIMITS = {4: (32, 16), 6: (64, 48)}
+# How many minutes late a log line may be (nginx logs requests once they complete)
+# before its one-minute burst window is closed.
+WINDOW_GRACE = 1
+
+
+class LogRange(NamedTuple):
+    """A newline-aligned byte range of a log (up to EOF if end is None)."""
+
+    path: Path
+    start: int = 0
+    end: Optional[int] = None
 
 
 @dataclass
-class LogEntry:
-    source_ip: str
-    timestamp: datetime
-    request: str
-    status: int
-    useragent: str
-
-
-def parse_log_entry(line) -> LogEntry:
-    match = NGINX_LOG_REGEX.match(line)
-    assert match, f"should match! ({line})"
-    return LogEntry(
-        source_ip=match.group("src"),
-        # Reference: https://en.wikipedia.org/wiki/Common_Log_Format
-        timestamp=datetime.strptime(match.group("timestamp"), "%d/%b/%Y:%H:%M:%S %z"),
-        request=match.group("request"),
-        status=int(match.group("status")),
-        useragent=match.group("useragent"),
-    )
+class MalformedLines:
+    count: int = 0
+    # (file name, line number, line)
+    examples: list[tuple[str, int, str]] = field(default_factory=list)
+    max_examples: int = 5
 
+    def add(self, path: Path, lineno: int, line: str) -> None:
+        self.count += 1
+        if len(self.examples) < self.max_examples:
+            self.examples.append((path.name, lineno, line[:200]))
 
-@click.command()
-@click.argument("nginx-log-path", type=click.Path(exists=True, resolve_path=True, path_type=Path))
-@click.option("--update-iptables", default="NO", type=click.Choice(["NO", "LOG_DROP", "LOG_REJECT"]))
-def main(nginx_log_path: Path, update_iptables: str) -> None:
-    t0 = time.perf_counter()
-    blob = nginx_log_path.read_text(encoding="utf-8")
-    logs = [parse_log_entry(line) for line in blob.splitlines()]
-    elapsed = time.perf_counter() - t0
-    console.log(f"[dim]Parsed {len(logs)} logs in {elapsed:.3f}s")
+    def merge(self, other: "MalformedLines", line_offset: int = 0) -> None:
+        """Fold in the malformed lines of a later span, shifting its line numbers."""
+        self.count += other.count
+        for name, lineno, line in other.examples[:self.max_examples - len(self.examples)]:
+            self.examples.append((name, lineno + line_offset, line))
+
+
+class StringTable:
+    """Intern strings, mapping each distinct one to a small integer ID."""
+
+    def __init__(self) -> None:
+        self.values: list[str] = []
+        self._ids: dict[str, int] = {}
+
+    def intern(self, value: str) -> int:
+        id = self._ids.get(value)
+        if id is None:
+            id = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return id
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class TimestampCache:
+    """Parse nginx timestamps into UNIX epochs, caching the result for each second.
+
+    Consecutive lines almost always share a timestamp (or a recent one), so most lines
+    skip strptime entirely. The cache is cleared once it grows past `max_size`.
+    """
+
+    def __init__(self, max_size: int = 4096) -> None:
+        self.max_size = max_size
+        self._cache: dict[str, int] = {}
+
+    def parse(self, timestamp: str) -> int:
+        epoch = self._cache.get(timestamp)
+        if epoch is None:
+            if len(self._cache) >= self.max_size:
+                self._cache.clear()
+            # Reference: https://en.wikipedia.org/wiki/Common_Log_Format
+            epoch = int(datetime.strptime(timestamp, "%d/%b/%Y:%H:%M:%S %z").timestamp())
+            self._cache[timestamp] = epoch
+        return epoch
+
+
+class LogColumns:
+    """Parsed log entries, stored column-wise.
+
+    Strings are interned into per-column tables and each line costs a few array slots
+    (about 23 bytes) instead of a dataclass instance with a datetime. Only the path of
+    each request is kept (scanners make the query strings practically unique), along
+    with whether the request touched the API.
+    """
+
+    def __init__(self) -> None:
+        self.ips = StringTable()
+        self.paths = StringTable()
+        self.useragents = StringTable()
+        self.ip = array("I")
+        self.path = array("I")
+        self.api = bytearray()
+        self.useragent = array("I")
+        self.status = array("H")
+        self.timestamp = array("q")
+        self._timestamps = TimestampCache()
+
+    def __len__(self) -> int:
+        return len(self.status)
+
+    def add_line(self, line: str) -> bool:
+        """Parse and append a log line. Return False (appending nothing) if it's malformed."""
+        match = NGINX_LOG_REGEX.match(line)
+        if match is None:
+            return False
+
+        src, timestamp, request, status, _, _, useragent = match.groups()
+        self.ip.append(self.ips.intern(src))
+        self.path.append(self.paths.intern(request_path(request)))
+        self.api.append("/api" in request)
+        self.useragent.append(self.useragents.intern(useragent))
+        self.status.append(int(status))
+        self.timestamp.append(self._timestamps.parse(timestamp))
+        return True
+
+
+class BurstThresholds(NamedTuple):
+    """Per-IP limits for a one-minute window. Exceeding any of them flags the IP."""
+
+    requests: int = 120
+    error_ratio: float = 0.5
+    # The error ratio is only checked for windows with at least this many requests.
+    min_requests: int = 20
+    distinct_paths: int = 30
+
+
+@dataclass
+class Window:
+    """What an IP did within one minute."""
+
+    requests: int = 0
+    errors: int = 0
+    # Only tracked up to distinct_paths + 1, which is enough to tell.
+    paths: set[str] = field(default_factory=set)
+
+    def merge(self, other: "Window") -> None:
+        self.requests += other.requests
+        self.errors += other.errors
+        self.paths.update(other.paths)
+
+    def check(self, thresholds: BurstThresholds) -> Optional[str]:
+        """Return why the (complete) window is a burst, if it is one.
+
+        Only call this once the window is complete, so the reason doesn't depend on how
+        the log was split up (with --jobs or --state).
+        """
+        if self.requests > thresholds.requests:
+            return f"{self.requests} requests/min"
+        if len(self.paths) > thresholds.distinct_paths:
+            # Paths are only tracked up to the limit, so their exact count isn't known.
+            return f"over {thresholds.distinct_paths} distinct paths/min"
+        if self.requests >= thresholds.min_requests:
+            if self.errors / self.requests >= thresholds.error_ratio:
+                return f"{self.errors}/{self.requests} errors/min"
+        return None
+
+
+def request_path(request: str) -> str:
+    """Return the path (without the query string) of a request line like "GET / HTTP/1.1"."""
+    parts = request.split(" ")
+    path = parts[1] if len(parts) >= 2 else request
+    return path.partition("?")[0]
+
+
+@dataclass
+class Summary:
+    """The aggregates the report (and the blocklist) is built from."""
+
+    lines: int = 0
+    first_timestamp: Optional[int] = None
+    last_timestamp: Optional[int] = None
+    status_frequency: Counter = field(default_factory=Counter)
+    useragents_by_ip: dict[str, set[str]] = field(default_factory=lambda: defaultdict(set))
+    # IPs that got a successful response or touched the API at least once.
+    legitimate_ips: set[str] = field(default_factory=set)
+    # IP -> (minute, reason) of its earliest burst.
+    burst_ips: dict[str, tuple[int, str]] = field(default_factory=dict)
+    # Burst windows that may still be incomplete: the latest ones, and the first ones of
+    # each parsed range (the previous range may hold the rest of them).
+    open_windows: dict[tuple[str, int], Window] = field(default_factory=dict)
+
+    @property
+    def suspect_ips(self) -> set[str]:
+        return (set(self.useragents_by_ip) - self.legitimate_ips) | set(self.burst_ips)
+
+    def flag_burst(self, ip: str, minute: int, reason: str) -> None:
+        if ip not in self.burst_ips or minute < self.burst_ips[ip][0]:
+            self.burst_ips[ip] = (minute, reason)
+
+    def close_windows(self, thresholds: BurstThresholds, before: Optional[int] = None) -> None:
+        """Check and forget the open windows older than `before` (a minute), or all of them."""
+        for (ip, minute), window in list(self.open_windows.items()):
+            if before is None or minute < before:
+                if reason := window.check(thresholds):
+                    self.flag_burst(ip, minute, reason)
+                del self.open_windows[ip, minute]
+
+    def merge(self, other: "Summary") -> None:
+        self.lines += other.lines
+        if self.first_timestamp is None:
+            self.first_timestamp = other.first_timestamp
+            self.last_timestamp = other.last_timestamp
+        elif other.first_timestamp is not None:
+            self.first_timestamp = min(self.first_timestamp, other.first_timestamp)
+            self.last_timestamp = max(self.last_timestamp, other.last_timestamp)
+        self.status_frequency.update(other.status_frequency)
+        for ip, useragents in other.useragents_by_ip.items():
+            self.useragents_by_ip[ip].update(useragents)
+        self.legitimate_ips.update(other.legitimate_ips)
+        for ip, (minute, reason) in other.burst_ips.items():
+            self.flag_burst(ip, minute, reason)
+        for key, window in other.open_windows.items():
+            if key in self.open_windows:
+                self.open_windows[key].merge(window)
+            else:
+                self.open_windows[key] = window
+
+    def to_json(self) -> dict[str, object]:
+        return {
+            "lines": self.lines,
+            "first_timestamp": self.first_timestamp,
+            "last_timestamp": self.last_timestamp,
+            "status_frequency": {str(s): count for s, count in self.status_frequency.items()},
+            "useragents_by_ip": {ip: sorted(uas) for ip, uas in self.useragents_by_ip.items()},
+            "legitimate_ips": sorted(self.legitimate_ips),
+            "burst_ips": self.burst_ips,
+            "open_windows": [
+                [ip, minute, w.requests, w.errors, sorted(w.paths)]
+                for (ip, minute), w in self.open_windows.items()
+            ],
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Summary":
+        summary = cls(
+            lines=data["lines"],
+            first_timestamp=data["first_timestamp"],
+            last_timestamp=data["last_timestamp"],
+            status_frequency=Counter({int(s): count for s, count in data["status_frequency"].items()}),
+            legitimate_ips=set(data["legitimate_ips"]),
+            burst_ips={ip: tuple(burst) for ip, burst in data["burst_ips"].items()},
+        )
+        for ip, useragents in data["useragents_by_ip"].items():
+            summary.useragents_by_ip[ip] = set(useragents)
+        for ip, minute, requests, errors, paths in data["open_windows"]:
+            summary.open_windows[ip, minute] = Window(requests, errors, set(paths))
+        return summary
+
+
+@dataclass
+class LogState:
+    """How far into a live log previous runs got, and what they found (for --state)."""
+
+    inode: int
+    offset: int
+    summary: Summary
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["LogState"]:
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text(encoding="utf-8"))
+        return cls(data["inode"], data["offset"], Summary.from_json(data["summary"]))
+
+    def save(self, path: Path) -> None:
+        data = {"inode": self.inode, "offset": self.offset, "summary": self.summary.to_json()}
+        # Write then rename so an interrupted run can't leave a truncated state file.
+        write_atomically(path, json.dumps(data))
+
+
+def summarize(columns: LogColumns, thresholds: BurstThresholds) -> Summary:
+    """Run the counting and suspicion passes over the columns.
+
+    Bursts are detected in the same pass with fixed one-minute windows per IP. Only the
+    windows of the last couple of minutes are held in memory, and windows that can't be
+    complete yet are left open in the summary so they can be merged with other ranges.
+    """
+    summary = Summary(lines=len(columns))
+    if not columns:
+        return summary
+
+    summary.first_timestamp = min(columns.timestamp)
+    summary.last_timestamp = max(columns.timestamp)
+    summary.status_frequency.update(columns.status)
+    paths = columns.paths.values
+    ips = columns.ips.values
+    legitimate = bytearray(len(columns.ips))
+    windows = summary.open_windows
+    first_minute = newest_minute = columns.timestamp[0] // 60
+    for ip, path, api, status, timestamp in zip(
+        columns.ip, columns.path, columns.api, columns.status, columns.timestamp
+    ):
+        if (200 <= status < 400) or api:
+            legitimate[ip] = 1
+
+        minute = timestamp // 60
+        if minute > newest_minute:
+            newest_minute = minute
+            closable = [
+                key for key in windows
+                if first_minute + WINDOW_GRACE < key[1] < minute - WINDOW_GRACE
+            ]
+            for key in closable:
+                if reason := windows.pop(key).check(thresholds):
+                    summary.flag_burst(key[0], key[1], reason)
+        window = windows.get((ips[ip], minute))
+        if window is None:
+            window = windows[ips[ip], minute] = Window()
+        window.requests += 1
+        window.errors += status >= 400
+        if len(window.paths) <= thresholds.distinct_paths:
+            window.paths.add(paths[path])
+    for ip, useragent in set(zip(columns.ip, columns.useragent)):
+        summary.useragents_by_ip[columns.ips.values[ip]].add(columns.useragents.values[useragent])
+    summary.legitimate_ips = {columns.ips.values[ip] for ip, flag in enumerate(legitimate) if flag}
+    return summary
+
+
+def open_log(path: Path) -> IO[bytes]:
+    """Open a log for reading line by line, decompressing rotated (.gz) logs on the fly."""
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def read_lines(span: LogRange) -> Iterator[str]:
+    with open_log(span.path) as f:
+        position = span.start
+        f.seek(position)
+        for line in f:
+            yield line.rstrip(b"\r\n").decode("utf-8", errors="replace")
+            position += len(line)
+            if span.end is not None and position >= span.end:
+                break
+
+
+def load_range(columns: LogColumns, span: LogRange, malformed: MalformedLines) -> int:
+    """Parse a range of a log into the columns. Return the number of lines read."""
+    lineno = 0
+    for lineno, line in enumerate(read_lines(span), start=1):
+        if line and not columns.add_line(line):
+            malformed.add(span.path, lineno, line)
+    return lineno
+
+
+def load_logs(spans: Iterable[LogRange], malformed: MalformedLines) -> LogColumns:
+    """Stream and parse one or more logs, in order, recording unparseable lines."""
+    columns = LogColumns()
+    for span in spans:
+        load_range(columns, span, malformed)
+    return columns
+
+
+def split_range(span: LogRange, jobs: int) -> list[LogRange]:
+    """Split a range of a log into newline-aligned ranges for parallel parsing.
+
+    Gzipped logs can't be seeked through efficiently so they're never split.
+    """
+    end = span.path.stat().st_size if span.end is None else span.end
+    if span.path.suffix == ".gz" or end <= span.start:
+        return [span]
+
+    chunk_size = max(1, min(MAX_CHUNK_SIZE, -(-(end - span.start) // jobs)))
+    spans = []
+    with open(span.path, "rb") as f:
+        start = span.start
+        while start < end:
+            chunk_end = start + chunk_size
+            if chunk_end < end:
+                # Extend the range to the end of the line straddling the boundary.
+                f.seek(chunk_end - 1)
+                f.readline()
+                chunk_end = f.tell()
+            spans.append(LogRange(span.path, start, min(chunk_end, end)))
+            start = chunk_end
+    return spans
 
-    by_ip = defaultdict(list)
-    useragents = set()
-    for entry in logs:
-        by_ip[entry.source_ip].append(entry)
-        useragents.add(entry.useragent)
 
-    rprint(f"[bold]Unique source IPs: {len(by_ip)}")
+def complete_lines_end(path: Path, start: int) -> int:
+    """Return the offset just past the last complete line of a log (at or after start)."""
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > start:
+            block_start = max(start, end - 64 * 1024)
+            f.seek(block_start)
+            newline = f.read(end - block_start).rfind(b"\n")
+            if newline != -1:
+                return block_start + newline + 1
+            end = block_start
+    return start
+
+
+def find_rotated_log(path: Path, inode: int) -> Optional[Path]:
+    """Find where a log was rotated to (access.log -> access.log.1) by its inode."""
+    for candidate in path.parent.glob(f"{path.name}.*"):
+        if candidate.suffix != ".gz" and candidate.stat().st_ino == inode:
+            return candidate
+    return None
+
+
+def pending_spans(path: Path, state: Optional[LogState]) -> tuple[list[LogRange], int, int]:
+    """Return the ranges of a live log not processed yet, plus its new inode and offset.
+
+    Only complete lines are included, so a line being written is picked up next time.
+    """
+    inode = path.stat().st_ino
+    spans = []
+    start = 0
+    if state is not None:
+        if state.inode == inode and state.offset <= path.stat().st_size:
+            start = state.offset
+        elif state.inode == inode:
+            console.log(f"[yellow]{path.name} was truncated, reading it from the start")
+        elif rotated := find_rotated_log(path, state.inode):
+            console.log(f"[dim]{path.name} was rotated to {rotated.name}, finishing it first")
+            spans.append(LogRange(rotated, state.offset))
+        else:
+            console.log(
+                f"[yellow]{path.name} was rotated and its old copy wasn't found (compressed?),"
+                " lines written to it since the last run are missed"
+            )
+    end = complete_lines_end(path, start)
+    if end > start:
+        spans.append(LogRange(path, start, end))
+    return spans, inode, end
+
+
+def analyze_range(
+    span: LogRange, thresholds: BurstThresholds
+) -> tuple[Summary, MalformedLines, int]:
+    """Parse and summarize a range on its own (in a worker process)."""
+    columns = LogColumns()
+    malformed = MalformedLines()
+    lines = load_range(columns, span, malformed)
+    return summarize(columns, thresholds), malformed, lines
+
+
+def analyze_logs_parallel(
+    spans: Iterable[LogRange], jobs: int, thresholds: BurstThresholds
+) -> tuple[Summary, MalformedLines]:
+    """Like summarize(load_logs(...)) but with the parsing spread over worker processes."""
+    chunks = [chunk for span in spans for chunk in split_range(span, jobs)]
+    summary = Summary()
+    malformed = MalformedLines()
+    line_offset = 0
+    with ProcessPoolExecutor(jobs) as executor:
+        # map() yields in order so line numbers can be fixed up as the results arrive.
+        for i, (chunk_summary, chunk_malformed, lines) in enumerate(
+            executor.map(functools.partial(analyze_range, thresholds=thresholds), chunks)
+        ):
+            if i == 0 or chunks[i - 1].path != chunks[i].path:
+                line_offset = 0
+            summary.merge(chunk_summary)
+            malformed.merge(chunk_malformed, line_offset)
+            line_offset += lines
+    return summary, malformed
+
+
+def analyze_logs(
+    spans: list[LogRange], jobs: int, thresholds: BurstThresholds
+) -> tuple[Summary, MalformedLines]:
+    if jobs > 1:
+        return analyze_logs_parallel(spans, jobs, thresholds)
+    malformed = MalformedLines()
+    return summarize(load_logs(spans, malformed), thresholds), malformed
+
+
+IPAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+@dataclass
+class PrefixTree:
+    """The binary prefix tree over one IP version's (sorted) addresses.
+
+    Addresses are bucketed into units of `host_prefix` bits, e.g. /64s for IPv6.
+    """
+
+    network_cls: type[IPNetwork]
+    host_prefix: int
+    min_prefix: int
+    shift: int
+    density: float
+    hosts: dict[int, list[IPAddress]]
+    excluded: list[int]
+    units: list[int] = field(init=False)
+    found: list[IPNetwork] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        self.units = sorted(self.hosts)
+
+    def walk(self, start: int, end: int, prefix: int, length: int) -> None:
+        # This node covers the hosts [first, last) which are units[start:end].
+        host_bits = self.host_prefix - length
+        first, last = prefix << host_bits, (prefix + 1) << host_bits
+        clean = bisect_left(self.excluded, first) == bisect_left(self.excluded, last)
+        # A lone host is never widened into a block covering its neighbours.
+        needed = 1 if host_bits == 0 else max(2, self.density * (1 << host_bits))
+        if length >= self.min_prefix and clean and end - start >= needed:
+            self.found.append(self.network_cls((first << self.shift, length)))
+        elif length == self.host_prefix:
+            # A host sharing its /64 with someone legitimate: block just the addresses.
+            self.found.extend(self.network_cls(address) for address in self.hosts[first])
+        else:
+            mid = bisect_left(self.units, (2 * prefix + 1) << (host_bits - 1), start, end)
+            if mid > start:
+                self.walk(start, mid, 2 * prefix, length + 1)
+            if end > mid:
+                self.walk(mid, end, 2 * prefix + 1, length + 1)
+
+
+def aggregate_networks(
+    ips: Iterable[str], keep_out: Iterable[str], density: float
+) -> list[IPNetwork]:
+    """Collapse addresses into as few CIDR blocks as possible.
+
+    The binary prefix tree over the (sorted) addresses is walked top-down, and a subtree
+    becomes a single block once at least `density` of its hosts are in `ips` and none
+    are in `keep_out`. Blocks are never wider than allowed by CIDR_LIMITS.
+    """
+    ips = [ipaddress.ip_address(ip) for ip in ips]
+    keep_out = [ipaddress.ip_address(ip) for ip in keep_out]
+    networks: list[IPNetwork] = []
+    for version, (host_prefix, min_prefix) in CIDR_LIMITS.items():
+        network_cls = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+        shift = network_cls(0).max_prefixlen - host_prefix
+        hosts = defaultdict(list)
+        for address in ips:
+            if address.version == version:
+                hosts[int(address) >> shift].append(address)
+        excluded = sorted({int(a) >> shift for a in keep_out if a.version == version})
+        tree = PrefixTree(network_cls, host_prefix, min_prefix, shift, density, hosts, excluded)
+        if tree.units:
+            tree.walk(0, len(tree.units), 0, 0)
+        networks.extend(ipaddress.collapse_addresses(tree.found))
+    return networks
+
+
+def write_atomically(path: Path, text: str) -> None:
+    """Write then rename, so an interrupted run (or a reader) never sees a partial file."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def write_blocklist_file(path: Path, networks: Iterable[IPNetwork]) -> None:
+    """Write a blocklist file, with one CIDR block per line."""
+    header = f"# Written by ipfiltering.py at {datetime.now(timezone.utc):%Y-%m-%d %H:%M:%S} UTC"
+    write_atomically(path, "\n".join([header, *map(str, networks)]) + "\n")
+
+
+class FirewallPayload(NamedTuple):
+    command: list[str]
+    payload: str
+
+
+@dataclass
+class Firewall:
+    """Block IPs with one atomic iptables-restore (or ipset restore) call per IP version.
+
+    The current blocklist is read first so addresses that are already blocked are
+    skipped. With the ipset backend, addresses go into a hash:net set matched by a
+    single iptables rule, which keeps packet filtering cheap however long the list
+    gets. With `dry_run`, the payloads are written to that file instead of applied.
+    """
+
+    target: str
+    backend: str = "iptables"
+    dry_run: Optional[Path] = None
+
+    def block(self, ips: Iterable[Union[str, IPNetwork]]) -> int:
+        """Block the addresses (or networks) not blocked yet. Return how many were new."""
+        networks = {ipaddress.ip_network(ip, strict=False) for ip in ips}
+        payloads = []
+        new = 0
+        for version in (4, 6):
+            wanted = {n for n in networks if n.version == version}
+            if not wanted:
+                continue
+            if self.backend == "ipset":
+                version_payloads, version_new = self._plan_ipset(version, wanted)
+            else:
+                version_payloads, version_new = self._plan_iptables(version, wanted)
+            payloads.extend(version_payloads)
+            new += version_new
+
+        if self.dry_run is not None:
+            with open(self.dry_run, "w", encoding="utf-8") as f:
+                for command, payload in payloads:
+                    f.write(f"# {shlex.join(command)}\n{payload}")
+            console.log(f"Wrote firewall update for {new} new network(s) to {self.dry_run}")
+        else:
+            for command, payload in payloads:
+                subprocess.run(command, input=payload, text=True, check=True)
+            console.log(f"Blocked {new} new network(s) ({len(networks) - new} already blocked)")
+        return new
+
+    def _plan_iptables(self, version: int, wanted: set) -> tuple[list[FirewallPayload], int]:
+        blocked = set()
+        for args in self._read_rules(version):
+            if "-s" in args:
+                blocked.add(ipaddress.ip_network(args[args.index("-s") + 1], strict=False))
+        new = sorted(n for n in wanted if not any(n.subnet_of(b) for b in blocked))
+        if not new:
+            return [], 0
+
+        rules = [
+            f"-A INPUT -s {network} -m comment --comment {FIREWALL_TAG} -j {self.target}"
+            for network in new
+        ]
+        return [self._iptables_restore(version, rules)], len(new)
+
+    def _plan_ipset(self, version: int, wanted: set) -> tuple[list[FirewallPayload], int]:
+        name = FIREWALL_TAG if version == 4 else f"{FIREWALL_TAG}6"
+        members = set()
+        for line in self._read(["ipset", "save", name], missing_ok=True).splitlines():
+            if line.startswith(f"add {name} "):
+                members.add(ipaddress.ip_network(line.split()[2], strict=False))
+        new = sorted(n for n in wanted if not any(n.subnet_of(m) for m in members))
+        payloads = []
+        if new:
+            family = "inet" if version == 4 else "inet6"
+            lines = [f"create {name} hash:net family {family} -exist"]
+            lines.extend(f"add {name} {network} -exist" for network in new)
+            payloads.append(FirewallPayload(["ipset", "restore"], "\n".join(lines) + "\n"))
+        if not any(name in args and "--match-set" in args for args in self._read_rules(version)):
+            rule = (
+                f"-A INPUT -m set --match-set {name} src"
+                f" -m comment --comment {FIREWALL_TAG} -j {self.target}"
+            )
+            payloads.append(self._iptables_restore(version, [rule]))
+        return payloads, len(new)
+
+    def _read_rules(self, version: int) -> list[list[str]]:
+        """Return the arguments of the INPUT rules managed by us."""
+        command = ["iptables-save" if version == 4 else "ip6tables-save", "-t", "filter"]
+        rules = []
+        for line in self._read(command).splitlines():
+            if line.startswith("-A INPUT ") and FIREWALL_TAG in line:
+                args = shlex.split(line)
+                if args[args.index("--comment") + 1] == FIREWALL_TAG:
+                    rules.append(args)
+        return rules
+
+    def _read(self, command: list[str], missing_ok: bool = False) -> str:
+        try:
+            return subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            if not missing_ok and self.dry_run is None:
+                raise
+            if not missing_ok:
+                console.log(f"[yellow]Couldn't read the current blocklist ({e}), assuming it's empty")
+            return ""
+
+    @staticmethod
+    def _iptables_restore(version: int, rules: list[str]) -> FirewallPayload:
+        command = ["iptables-restore" if version == 4 else "ip6tables-restore", "--noflush"]
+        return FirewallPayload(command, "\n".join(["*filter", *rules, "COMMIT"]) + "\n")
+
+
+def follow_log(
+    path: Path,
+    state: LogState,
+    state_path: Optional[Path],
+    jobs: int,
+    interval: float,
+    thresholds: BurstThresholds,
+    on_new_suspects: Callable[[Summary], None],
+) -> None:
+    """Poll a live log for new lines, flagging new suspicious IPs as they show up."""
+    flagged = state.summary.suspect_ips
+    console.log(f"Following {path.name} (Ctrl-C to stop) ...")
+    try:
+        while True:
+            time.sleep(interval)
+            spans, state.inode, state.offset = pending_spans(path, state)
+            if not spans:
+                continue
+
+            summary, malformed = analyze_logs(spans, jobs, thresholds)
+            state.summary.merge(summary)
+            if state.summary.lines:
+                last_minute = state.summary.last_timestamp // 60
+                state.summary.close_windows(thresholds, last_minute - WINDOW_GRACE)
+            if malformed.count:
+                console.log(f"[red]Skipped {malformed.count} malformed line(s)")
+            new_suspects = state.summary.suspect_ips - flagged
+            for ip in sorted(new_suspects):
+                useragents = ", ".join(sorted(state.summary.useragents_by_ip[ip]))
+                burst = state.summary.burst_ips.get(ip)
+                reason = f"burst: {burst[1]}, " if burst else ""
+                console.log(
+                    f"[bold orange3]New suspicious source IP[/]: {ip} [dim]({reason}{useragents})"
+                )
+            flagged |= new_suspects
+            if new_suspects:
+                on_new_suspects(state.summary)
+            if state_path is not None:
+                state.save(state_path)
+    except KeyboardInterrupt:
+        pass
+
+
+def print_report(summary: Summary, malformed: MalformedLines) -> None:
+    if malformed.count:
+        rprint(f"[bold red]Skipped {malformed.count} malformed line(s)[/], e.g.:")
+        for name, lineno, line in malformed.examples:
+            rprint(f"  {name}:{lineno}: {line}", style="dim", highlight=False, markup=False)
+
+    if summary.lines:
+        start = datetime.fromtimestamp(summary.first_timestamp, timezone.utc)
+        end = datetime.fromtimestamp(summary.last_timestamp, timezone.utc)
+        rprint(f"[bold]Time span: {start:%Y-%m-%d %H:%M:%S} -> {end:%Y-%m-%d %H:%M:%S} UTC")
+    useragents = set().union(*summary.useragents_by_ip.values())
+    rprint(f"[bold]Unique source IPs: {len(summary.useragents_by_ip)}")
     rprint(f"[bold]Unique user-agents: {len(useragents)}")
 
-    status_frequency = Counter([e.status for e in logs])
     rprint("[bold]Status breakdown:")
-    for s, count in sorted(status_frequency.items(), key=lambda kv: kv[1], reverse=True):
+    for s, count in sorted(summary.status_frequency.items(), key=lambda kv: kv[1], reverse=True):
         desc = http.client.responses.get(s, "-")
         rprint(f"  [cyan]{count}[/]: {s} [magenta]{desc}[/]", highlight=False)
 
-    suspect_ips = set(by_ip)
-    for entry in logs:
-        if (200 <= entry.status < 400) or "/api" in entry.request:
-            if entry.source_ip in suspect_ips:
-                suspect_ips.remove(entry.source_ip)
+    suspect_ips = summary.suspect_ips
     console.line()
     rprint(f"[bold orange3]Suspicious source IPs[/]: {len(suspect_ips)}")
+    if summary.burst_ips:
+        rprint(f"[orange3] -> Bursting source IPs[/]: {len(summary.burst_ips)}")
+        bursts = sorted(summary.burst_ips.items(), key=lambda kv: kv[1])
+        for ip, (minute, reason) in bursts[:10]:
+            at = datetime.fromtimestamp(minute * 60, timezone.utc)
+            rprint(f"    {ip} [dim]({reason} at {at:%Y-%m-%d %H:%M} UTC)", highlight=False)
+        if len(bursts) > 10:
+            rprint(f"    [dim]... and {len(bursts) - 10} more")
 
     suspect_useragents = {}
     for ip in suspect_ips:
-        for entry in by_ip[ip]:
-            suspect_useragents[entry.useragent] = ip
+        for useragent in summary.useragents_by_ip[ip]:
+            suspect_useragents[useragent] = ip
     rprint(f"[orange3] -> Suspicious useragents[/]: {len(suspect_useragents)}")
 
+
+@click.command()
+@click.argument(
+    "nginx-log-paths",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option("--update-iptables", default="NO", type=click.Choice(["NO", "LOG_DROP", "LOG_REJECT"]))
+@click.option(
+    "--firewall-backend",
+    default="iptables",
+    type=click.Choice(["iptables", "ipset"]),
+    help="Block with one iptables rule per address, or a single rule matching an ipset.",
+)
+@click.option(
+    "--firewall-dry-run",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Write the firewall update payloads to this file instead of applying them.",
+)
+@click.option(
+    "--jobs", "-j", default=1, type=click.IntRange(min=1), help="Parse with this many processes."
+)
+@click.option(
+    "--state",
+    "state_path",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Remember progress (and findings) here, so later runs only process new lines.",
+)
+@click.option("--follow", is_flag=True, help="Keep watching the log for new suspicious IPs.")
+@click.option(
+    "--interval",
+    default=5.0,
+    type=click.FloatRange(min=0.1),
+    help="Seconds between polls when following.",
+)
+@click.option(
+    "--burst-requests",
+    default=BurstThresholds().requests,
+    type=click.IntRange(min=1),
+    help="Flag IPs making more requests than this within a minute.",
+)
+@click.option(
+    "--burst-error-ratio",
+    default=BurstThresholds().error_ratio,
+    type=click.FloatRange(min=0, max=1),
+    help="Flag IPs whose requests within a minute failed (4xx/5xx) at least this often.",
+)
+@click.option(
+    "--burst-min-requests",
+    default=BurstThresholds().min_requests,
+    type=click.IntRange(min=1),
+    help="Only check the error ratio of minutes with at least this many requests.",
+)
+@click.option(
+    "--cidr-density",
+    default=0.5,
+    type=click.FloatRange(min=0, max=1, min_open=True),
+    help="Block a whole CIDR range once this fraction of its addresses are suspicious.",
+)
+@click.option(
+    "--write-blocklist",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Write the suspicious CIDR blocks to this file, one per line.",
+)
+@click.option(
+    "--burst-paths",
+    default=BurstThresholds().distinct_paths,
+    type=click.IntRange(min=1),
+    help="Flag IPs requesting more distinct paths than this within a minute.",
+)
+def main(
+    nginx_log_paths: tuple[Path, ...],
+    update_iptables: str,
+    firewall_backend: str,
+    firewall_dry_run: Optional[Path],
+    jobs: int,
+    state_path: Optional[Path],
+    follow: bool,
+    interval: float,
+    burst_requests: int,
+    burst_error_ratio: float,
+    burst_min_requests: int,
+    burst_paths: int,
+    cidr_density: float,
+    write_blocklist: Optional[Path],
+) -> None:
+    """Analyze nginx access logs (plain or gzipped, oldest first) for suspicious clients.
+
+    With --state or --follow, pass only the live (uncompressed) log.
+    """
+    live = state_path is not None or follow
+    if live and (len(nginx_log_paths) != 1 or nginx_log_paths[0].suffix == ".gz"):
+        raise click.UsageError("--state and --follow need exactly one (uncompressed) log")
+    if firewall_dry_run is not None and update_iptables == "NO":
+        raise click.UsageError("--firewall-dry-run needs an --update-iptables target")
+    firewall = None
     if update_iptables != "NO":
-        console.log("Adding suspicious IPs to iptables ...")
-        for ip in suspect_ips:
-            subprocess.run(["iptables", "-A", "INPUT", "-s", ip, "-j", update_iptables])
+        firewall = Firewall(update_iptables, firewall_backend, firewall_dry_run)
+    thresholds = BurstThresholds(burst_requests, burst_error_ratio, burst_min_requests, burst_paths)
+
+    def update_blocklist(summary: Summary) -> None:
+        suspects = summary.suspect_ips
+        # Bursting IPs might have also made legitimate requests, they're still blocked.
+        networks = aggregate_networks(suspects, summary.legitimate_ips - suspects, cidr_density)
+        rprint(f"[orange3] -> Aggregated into CIDR blocks[/]: {len(networks)}")
+        if write_blocklist is not None:
+            write_blocklist_file(write_blocklist, networks)
+        if firewall is not None:
+            console.log("Adding suspicious IPs to the firewall ...")
+            firewall.block(networks)
+
+    t0 = time.perf_counter()
+    if live:
+        state = LogState.load(state_path) if state_path is not None else None
+        spans, inode, offset = pending_spans(nginx_log_paths[0], state)
+        summary, malformed = analyze_logs(spans, jobs, thresholds)
+    else:
+        spans = [LogRange(path) for path in nginx_log_paths]
+        summary, malformed = analyze_logs(spans, jobs, thresholds)
+        summary.close_windows(thresholds)
+    elapsed = time.perf_counter() - t0
+    lines = summary.lines + malformed.count
+    console.log(
+        f"[dim]Parsed {summary.lines} logs from {len(nginx_log_paths)} file(s) in {elapsed:.3f}s"
+        f" ({lines / elapsed:,.0f} lines/s, {jobs} job(s))"
+    )
+    if live:
+        if state is None:
+            state = LogState(inode, offset, summary)
+        else:
+            state.inode, state.offset = inode, offset
+            state.summary.merge(summary)
+        summary = state.summary
+        if summary.lines:
+            # The latest windows are left open, the next run may add to them.
+            summary.close_windows(thresholds, summary.last_timestamp // 60 - WINDOW_GRACE)
+        if state_path is not None:
+            state.save(state_path)
+    print_report(summary, malformed)
+    update_blocklist(summary)
+    if follow:
+        follow_log(
+            nginx_log_paths[0], state, state_path, jobs, interval, thresholds, update_blocklist
+        )
 
 
 if __name__ == "__main__":